@@ -0,0 +1,236 @@
+"""
+Workload and utilization statistics per timetable version.
+
+For every version: weekly teaching hours per teacher, how much of the
+teaching week each room is booked, and how full the booked rooms are
+(enrolled students of the class's groups against the room's capacity).
+
+A version's aggregates are built from one grouped query (one row per class
+with its room capacity and summed enrollment) and then kept up to date:
+saving or deleting a single class moves only that class's contribution, and
+the rendered statistics are cached until the next change. Bulk writes
+(imports, the solver), room capacity and enrollment changes drop the
+affected aggregates instead. Like the conflict index, aggregates live in
+the worker process and are dropped when classes or versions change in any
+worker.
+"""
+from datetime import time
+from threading import Lock
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from app.cache import reference_cache
+from app.etags import change_tracker
+from app.models import models
+from app.schemas import classes as schemas
+
+
+def _minutes(value: time) -> int:
+    return value.hour * 60 + value.minute
+
+
+# The teaching week room occupancy is measured against (the solver's default window)
+_WINDOW = schemas.SchedulingOptions()
+TEACHING_WEEK_MINUTES = len(_WINDOW.days) * (_minutes(_WINDOW.day_end) - _minutes(_WINDOW.day_start))
+
+
+class Contribution(NamedTuple):
+    """What one class adds to its version's aggregates"""
+    version_id: Optional[int]
+    teacher_id: int
+    room_id: int
+    minutes: int
+    recurring: bool
+    enrolled: int
+    capacity: int
+
+
+def _contribution_statement():
+    assignments = models.class_group_assignments
+    return (
+        select(
+            models.Class.class_id,
+            models.Class.version_id,
+            models.Class.teacher_id,
+            models.Class.room_id,
+            models.Class.start_time,
+            models.Class.end_time,
+            models.Class.date,
+            models.Room.capacity,
+            func.coalesce(func.sum(models.ClassGroup.enrollment_count), 0),
+        )
+        .join(models.Room, models.Room.room_id == models.Class.room_id)
+        .outerjoin(assignments, assignments.c.class_id == models.Class.class_id)
+        .outerjoin(models.ClassGroup, models.ClassGroup.class_group_id == assignments.c.class_group_id)
+        .where(models.Class.approval_status != schemas.ApprovalStatus.rejected)
+        .group_by(
+            models.Class.class_id,
+            models.Class.version_id,
+            models.Class.teacher_id,
+            models.Class.room_id,
+            models.Class.start_time,
+            models.Class.end_time,
+            models.Class.date,
+            models.Room.capacity,
+        )
+    )
+
+
+def _contributions(db: Session, statement) -> Dict[int, Contribution]:
+    return {
+        class_id: Contribution(
+            version_id, teacher_id, room_id, _minutes(end) - _minutes(start), on_date is None, int(enrolled), capacity
+        )
+        for class_id, version_id, teacher_id, room_id, start, end, on_date, capacity, enrolled in db.execute(statement)
+    }
+
+
+class _Aggregates:
+    """Running totals of one version; add and remove are O(1)"""
+
+    def __init__(self, version_id: int, contributions: Dict[int, Contribution]):
+        self.version_id = version_id
+        self.contributions: Dict[int, Contribution] = {}
+        # teacher_id -> [weekly minutes, one-off minutes, classes]
+        self.teachers: Dict[int, List[int]] = {}
+        # room_id -> [weekly minutes, one-off minutes, classes, enrolled seat-minutes,
+        #             offered seat-minutes, classes over capacity]
+        self.rooms: Dict[int, List[int]] = {}
+        self.rendered: Optional[schemas.VersionStats] = None
+        for class_id, contribution in contributions.items():
+            self.add(class_id, contribution)
+
+    def _apply(self, contribution: Contribution, sign: int):
+        weekly = contribution.minutes if contribution.recurring else 0
+        one_off = 0 if contribution.recurring else contribution.minutes
+        teacher = self.teachers.setdefault(contribution.teacher_id, [0, 0, 0])
+        teacher[0] += sign * weekly
+        teacher[1] += sign * one_off
+        teacher[2] += sign
+        if not teacher[2]:
+            del self.teachers[contribution.teacher_id]
+        room = self.rooms.setdefault(contribution.room_id, [0, 0, 0, 0, 0, 0])
+        room[0] += sign * weekly
+        room[1] += sign * one_off
+        room[2] += sign
+        room[3] += sign * contribution.enrolled * contribution.minutes
+        room[4] += sign * contribution.capacity * contribution.minutes
+        room[5] += sign * (contribution.enrolled > contribution.capacity)
+        if not room[2]:
+            del self.rooms[contribution.room_id]
+        self.rendered = None
+
+    def add(self, class_id: int, contribution: Contribution):
+        self.contributions[class_id] = contribution
+        self._apply(contribution, 1)
+
+    def remove(self, class_id: int):
+        contribution = self.contributions.pop(class_id, None)
+        if contribution is not None:
+            self._apply(contribution, -1)
+
+    def render(self) -> schemas.VersionStats:
+        if self.rendered is None:
+            enrolled = sum(room[3] for room in self.rooms.values())
+            offered = sum(room[4] for room in self.rooms.values())
+            self.rendered = schemas.VersionStats(
+                version_id=self.version_id,
+                class_count=len(self.contributions),
+                teaching_week_hours=TEACHING_WEEK_MINUTES / 60,
+                seat_utilization_percent=_percent(enrolled, offered),
+                teachers=[
+                    schemas.TeacherWorkload(
+                        teacher_id=teacher_id,
+                        weekly_hours=weekly / 60,
+                        one_off_hours=one_off / 60,
+                        class_count=count,
+                    )
+                    for teacher_id, (weekly, one_off, count) in sorted(self.teachers.items())
+                ],
+                rooms=[
+                    schemas.RoomUtilization(
+                        room_id=room_id,
+                        weekly_hours=weekly / 60,
+                        one_off_hours=one_off / 60,
+                        class_count=count,
+                        occupancy_percent=_percent(weekly, TEACHING_WEEK_MINUTES),
+                        seat_utilization_percent=_percent(seat_minutes, offered_minutes),
+                        over_capacity_classes=over,
+                    )
+                    for room_id, (weekly, one_off, count, seat_minutes, offered_minutes, over)
+                    in sorted(self.rooms.items())
+                ],
+            )
+        return self.rendered
+
+
+def _percent(part: int, whole: int) -> float:
+    return round(100 * part / whole, 1) if whole else 0.0
+
+
+class VersionStatsCache:
+    def __init__(self):
+        self._versions: Dict[int, _Aggregates] = {}
+        self._lock = Lock()
+        self._generation = 0
+
+    def invalidate(self, version_ids: Optional[Iterable[int]] = None):
+        """Drop the aggregates of version_ids (default: all versions)"""
+        with self._lock:
+            self._generation += 1
+            if version_ids is None:
+                self._versions.clear()
+            else:
+                for version_id in version_ids:
+                    self._versions.pop(version_id, None)
+
+    def get(self, db: Session, version_id: int) -> Optional[schemas.VersionStats]:
+        """Statistics of a version, or None if it does not exist"""
+        with self._lock:
+            aggregates = self._versions.get(version_id)
+            if aggregates is not None:
+                return aggregates.render()
+            generation = self._generation
+        if db.get(models.TimetableVersion, version_id) is None:
+            return None
+        statement = _contribution_statement().where(models.Class.version_id == version_id)
+        aggregates = _Aggregates(version_id, _contributions(db, statement))
+        with self._lock:
+            # Not stored if a class changed while loading
+            if self._generation == generation:
+                self._versions[version_id] = aggregates
+            return aggregates.render()
+
+    def class_saved(self, db: Session, class_id: int):
+        """Move a created or updated class's contribution (one query)"""
+        statement = _contribution_statement().where(models.Class.class_id == class_id)
+        contribution = _contributions(db, statement).get(class_id)
+        with self._lock:
+            self._generation += 1
+            self._remove(class_id)
+            if contribution is not None and contribution.version_id is not None:
+                aggregates = self._versions.get(contribution.version_id)
+                if aggregates is not None:
+                    aggregates.add(class_id, contribution)
+
+    def class_deleted(self, class_id: int):
+        with self._lock:
+            self._generation += 1
+            self._remove(class_id)
+
+    def _remove(self, class_id: int):
+        # A class may have moved between versions
+        for aggregates in self._versions.values():
+            if class_id in aggregates.contributions:
+                aggregates.remove(class_id)
+
+
+version_stats = VersionStatsCache()
+# Enrollment counts and room capacities are part of every class's contribution
+change_tracker.on_change("class_groups", version_stats.invalidate)
+reference_cache.on_invalidate("rooms", version_stats.invalidate)
+# Class and version writes in other workers; this worker's own move contributions in place
+change_tracker.on_remote_change("classes", version_stats.invalidate)
+change_tracker.on_remote_change("timetable_versions", version_stats.invalidate)
@@ -0,0 +1,211 @@
+"""
+Read-through cache for reference data.
+
+Locations, schools, courses, subjects and rooms change a few times per
+semester but are read on nearly every request. Validated response models are
+kept per namespace in a TTL/LRU cache and dropped by the write handlers. A
+namespace is also dropped when anything nested in its responses changes
+(a room embeds its location and owner course, ...).
+
+Invalidations go through a backend: by default only this process is cleared;
+with CACHE_INVALIDATION_URL=redis://... they are broadcast so every worker
+drops the same entries.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from fastapi import Response
+
+from app.metrics import Counter
+from app.pagination import NEXT_CURSOR_HEADER
+
+CACHE_TTL = float(os.getenv("CACHE_TTL", "300"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+
+# namespace -> namespaces whose responses embed it
+DEPENDENTS: Dict[str, Tuple[str, ...]] = {
+    "locations": ("schools", "courses", "subjects", "rooms"),
+    "schools": ("courses", "subjects", "rooms"),
+    "courses": ("subjects", "rooms"),
+    "subjects": (),
+    "rooms": (),
+}
+
+CACHE_REQUESTS = Counter("cache_requests_total", "Reference cache lookups", ["cache", "result"])
+CACHE_INVALIDATIONS = Counter("cache_invalidations_total", "Reference cache namespaces dropped", ["cache"])
+
+MISSING = object()
+
+
+class TTLCache:
+    """A thread-safe LRU mapping whose entries also expire after ttl seconds"""
+
+    def __init__(self, maxsize: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, Tuple[float, object]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            expires, value = entry
+            if expires < monotonic():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class LocalInvalidation:
+    """
+    Invalidations stay in this process (single worker, or tolerate TTL staleness).
+    Backends carry any JSON-serializable message; every subscriber, the
+    publishing worker included, receives it.
+    """
+
+    def start(self, callback: Callable[[Any], None]):
+        pass
+
+    def publish(self, message):
+        pass
+
+
+class RedisInvalidation:
+    """Broadcast invalidations to every worker over a Redis pub/sub channel"""
+
+    def __init__(self, url: str, channel: str = "horarios:cache-invalidation"):
+        self.channel = channel
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_INVALIDATION_URL requires the redis package")
+        self._client = redis.Redis.from_url(url)
+
+    def start(self, callback: Callable[[Any], None]):
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel: lambda message: callback(json.loads(message["data"]))})
+        pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def publish(self, message):
+        self._client.publish(self.channel, json.dumps(message))
+
+
+def invalidation_backend(channel: str = "horarios:cache-invalidation"):
+    url = os.getenv("CACHE_INVALIDATION_URL")
+    return RedisInvalidation(url, channel) if url else LocalInvalidation()
+
+
+class ReferenceCache:
+    def __init__(self, dependents: Dict[str, Tuple[str, ...]], backend=None):
+        self.dependents = dependents
+        self._caches = {namespace: TTLCache() for namespace in dependents}
+        # Bumped on every invalidation so a read that raced with a write
+        # does not store what it loaded before the write
+        self._generations = {namespace: 0 for namespace in dependents}
+        self._listeners: Dict[str, List[Callable[[], None]]] = {namespace: [] for namespace in dependents}
+        self._backend = backend or LocalInvalidation()
+        self._backend.start(self._clear)
+
+    def generation(self, namespace: str) -> int:
+        return self._generations[namespace]
+
+    def get(self, namespace: str, key):
+        value = self._caches[namespace].get(key)
+        CACHE_REQUESTS.inc(cache=namespace, result="miss" if value is MISSING else "hit")
+        return value
+
+    def set(self, namespace: str, key, value, generation: Optional[int] = None):
+        if generation is None or generation == self._generations[namespace]:
+            self._caches[namespace].set(key, value)
+
+    def load(self, namespace: str, key, loader: Callable):
+        """Cached value of key, calling loader() on a miss. None results are not cached."""
+        value = self.get(namespace, key)
+        if value is MISSING:
+            generation = self.generation(namespace)
+            value = loader()
+            if value is not None:
+                self.set(namespace, key, value, generation)
+        return value
+
+    def on_invalidate(self, namespace: str, callback: Callable[[], None]):
+        """Run callback whenever namespace is dropped, locally or by another worker"""
+        self._listeners[namespace].append(callback)
+
+    def invalidate(self, *namespaces: str):
+        """Drop namespaces and everything embedding them, in every worker"""
+        affected = self._clear(namespaces)
+        self._backend.publish(affected)
+
+    def _clear(self, namespaces: Iterable[str]) -> List[str]:
+        affected: List[str] = []
+        for namespace in namespaces:
+            for name in (namespace,) + self.dependents.get(namespace, ()):
+                if name in self._caches and name not in affected:
+                    affected.append(name)
+        for name in affected:
+            self._generations[name] += 1
+            self._caches[name].clear()
+            CACHE_INVALIDATIONS.inc(cache=name)
+            for callback in self._listeners[name]:
+                callback()
+        return affected
+
+    def _cached_page(self, namespace: str, response: Response, key):
+        cached = self.get(namespace, key)
+        if cached is MISSING:
+            return MISSING
+        items, next_cursor = cached
+        if next_cursor is not None:
+            response.headers[NEXT_CURSOR_HEADER] = next_cursor
+        return items
+
+    def _store_page(self, namespace: str, response: Response, key, items, generation: int):
+        self.set(namespace, key, (items, response.headers.get(NEXT_CURSOR_HEADER)), generation)
+
+    def page(self, namespace: str, response: Response, after, skip: int, limit: int, loader: Callable):
+        """
+        Cached list page. loader() runs the paginated query, which sets the
+        next-page cursor on response; the cursor is cached with the items.
+        """
+        key = ("page", after, skip, limit)
+        items = self._cached_page(namespace, response, key)
+        if items is MISSING:
+            generation = self.generation(namespace)
+            items = loader()
+            self._store_page(namespace, response, key, items, generation)
+        return items
+
+    async def page_async(self, namespace: str, response: Response, after, skip: int, limit: int, loader: Callable):
+        """page for a coroutine loader"""
+        key = ("page", after, skip, limit)
+        items = self._cached_page(namespace, response, key)
+        if items is MISSING:
+            generation = self.generation(namespace)
+            items = await loader()
+            self._store_page(namespace, response, key, items, generation)
+        return items
+
+
+reference_cache = ReferenceCache(DEPENDENTS, invalidation_backend())
@@ -0,0 +1,94 @@
+"""
+Room capacity against class group enrollment.
+
+A class's groups must fit in its room: the summed enrollment_count of its
+class groups may not exceed the room's capacity. Capacities per room and
+enrollments per group are kept in memory, loaded with two queries and
+dropped on room and class group writes (in every worker, through the
+reference cache and the change tracker), so checking a class write needs
+no database round trip.
+"""
+from threading import Lock
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from app.cache import reference_cache
+from app.etags import change_tracker
+from app.models import models
+
+
+class CapacitySnapshot(NamedTuple):
+    capacities: Dict[int, int]
+    enrollments: Dict[int, int]
+
+    def check(self, room_id: int, class_group_ids: Iterable[int]) -> Optional[Tuple[int, int]]:
+        """(enrolled, capacity) if the groups do not fit in the room, else None; unknown ids are ignored"""
+        capacity = self.capacities.get(room_id)
+        enrolled = sum(self.enrollments.get(group_id, 0) for group_id in set(class_group_ids))
+        if capacity is None or enrolled <= capacity:
+            return None
+        return enrolled, capacity
+
+
+class CapacityIndex:
+    def __init__(self):
+        self._lock = Lock()
+        self._snapshot: Optional[CapacitySnapshot] = None
+        self._generation = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._snapshot = None
+
+    def snapshot(self, db: Session) -> CapacitySnapshot:
+        """Current capacities and enrollments; an immutable snapshot, safe to use across invalidations"""
+        with self._lock:
+            snapshot, generation = self._snapshot, self._generation
+        if snapshot is None:
+            snapshot = CapacitySnapshot(
+                dict(db.execute(select(models.Room.room_id, models.Room.capacity)).all()),
+                dict(db.execute(select(models.ClassGroup.class_group_id, models.ClassGroup.enrollment_count)).all()),
+            )
+            with self._lock:
+                # Not published if a room or group changed while loading
+                if self._generation == generation:
+                    self._snapshot = snapshot
+        return snapshot
+
+
+capacity_index = CapacityIndex()
+reference_cache.on_invalidate("rooms", capacity_index.invalidate)
+change_tracker.on_change("class_groups", capacity_index.invalidate)
+
+
+def find_version_overcapacity(db: Session, version_id: int) -> Tuple[int, List[dict]]:
+    """Class count of a version and its classes whose groups do not fit in their room"""
+    snapshot = capacity_index.snapshot(db)
+    assignments = models.class_group_assignments
+    rows = db.execute(
+        select(models.Class.class_id, models.Class.room_id, assignments.c.class_group_id)
+        .outerjoin(assignments, assignments.c.class_id == models.Class.class_id)
+        .where(models.Class.version_id == version_id)
+        .order_by(models.Class.class_id)
+    )
+    classes: Dict[int, Tuple[int, List[int]]] = {}
+    for class_id, room_id, class_group_id in rows:
+        _, group_ids = classes.setdefault(class_id, (room_id, []))
+        if class_group_id is not None:
+            group_ids.append(class_group_id)
+    over = []
+    for class_id, (room_id, group_ids) in classes.items():
+        excess = snapshot.check(room_id, group_ids)
+        if excess is not None:
+            enrolled, capacity = excess
+            over.append({
+                "class_id": class_id,
+                "room_id": room_id,
+                "class_group_ids": sorted(group_ids),
+                "enrolled": enrolled,
+                "capacity": capacity,
+            })
+    return len(classes), over
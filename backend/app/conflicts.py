@@ -0,0 +1,399 @@
+"""
+In-process conflict index for class scheduling.
+
+Keeps one interval index per (timetable version, room/teacher, weekday) built
+from the classes table, so a class write can be checked for double bookings
+with a couple of binary searches instead of scanning the table.
+
+Writes in this worker update the index in place; it is only dropped (and
+rebuilt on next use) when classes or timetable versions change in another
+worker, through the change tracker. Class writes that can add bookings
+(create, update, generate, repair, import) hold their versions' write locks
+from the check until the index has the new classes, so two of them in this
+worker cannot both pass. Deletes cannot create a clash and clones write a
+version nobody else writes to yet, so neither takes a lock. Writes in
+different workers are not serialized.
+"""
+from bisect import bisect_left, bisect_right, insort
+from dataclasses import dataclass
+from contextlib import ExitStack, contextmanager
+from datetime import date, time
+from threading import Lock, RLock
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.etags import change_tracker
+from app.models import models
+
+
+DAY_MINUTES = 24 * 60
+
+
+def to_minutes(value: time) -> int:
+    """Convert a time of day to minutes since midnight"""
+    return value.hour * 60 + value.minute
+
+
+def minutes_to_time(minutes: int) -> time:
+    """Convert minutes since midnight back to a time of day, capped at 23:59"""
+    minutes = min(minutes, DAY_MINUTES - 1)
+    return time(minutes // 60, minutes % 60)
+
+
+@dataclass(frozen=True)
+class Booking:
+    class_id: int
+    start: int
+    end: int
+    date: Optional[date] = None
+
+    def clashes_with(self, other: "Booking") -> bool:
+        """Recurring bookings clash with every date on their weekday"""
+        if self.date is not None and other.date is not None and self.date != other.date:
+            return False
+        return self.start < other.end and other.start < self.end
+
+
+class IntervalIndex:
+    """
+    Bookings of a single resource on a single weekday, sorted by start.
+
+    Bookings never span more than a day, so every booking overlapping [start, end)
+    starts inside [start - max_length, end). Both bounds are found by bisection,
+    which keeps lookups at O(log n + k).
+    """
+
+    def __init__(self):
+        self._items: List[Tuple[int, int, int]] = []
+        self._bookings: Dict[int, Booking] = {}
+        self._max_length = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, booking: Booking):
+        insort(self._items, (booking.start, booking.end, booking.class_id))
+        self._bookings[booking.class_id] = booking
+        self._max_length = max(self._max_length, booking.end - booking.start)
+
+    def remove(self, class_id: int):
+        booking = self._bookings.pop(class_id, None)
+        if booking is None:
+            return
+        key = (booking.start, booking.end, booking.class_id)
+        position = bisect_left(self._items, key)
+        if position < len(self._items) and self._items[position] == key:
+            del self._items[position]
+
+    def overlapping(self, booking: Booking) -> List[Booking]:
+        low = bisect_left(self._items, (booking.start - self._max_length,))
+        high = bisect_right(self._items, (booking.end,))
+        found = []
+        for _, _, class_id in self._items[low:high]:
+            other = self._bookings[class_id]
+            if class_id != booking.class_id and booking.clashes_with(other):
+                found.append(other)
+        return found
+
+
+# (version_id, resource_id, day_of_week)
+IndexKey = Tuple[Optional[int], int, int]
+
+
+class ConflictIndex:
+    """Room and teacher interval indexes for every timetable version"""
+
+    RESOURCES = ("room", "teacher")
+
+    def __init__(self):
+        self._lock = RLock()
+        self._loaded = False
+        self._generation = 0
+        self._indexes: Dict[str, Dict[IndexKey, IntervalIndex]] = {
+            resource: {} for resource in self.RESOURCES
+        }
+        # class_id -> keys the class is registered under, per resource
+        self._keys: Dict[int, Dict[str, IndexKey]] = {}
+        self._write_locks: Dict[Optional[int], Lock] = {}
+
+    @staticmethod
+    def _weekday(day_of_week: Optional[int], on_date: Optional[date]) -> Optional[int]:
+        if on_date is not None:
+            return on_date.isoweekday()
+        return day_of_week
+
+    @staticmethod
+    def _resource_ids(class_obj) -> Dict[str, int]:
+        return {"room": class_obj.room_id, "teacher": class_obj.teacher_id}
+
+    def _is_indexed(self, class_obj) -> bool:
+        return (
+            class_obj.approval_status != models.ApprovalStatus.rejected
+            and class_obj.start_time is not None
+            and class_obj.end_time is not None
+            and self._weekday(class_obj.day_of_week, class_obj.date) is not None
+        )
+
+    def _booking(self, class_obj) -> Booking:
+        return Booking(
+            class_id=class_obj.class_id,
+            start=to_minutes(class_obj.start_time),
+            end=to_minutes(class_obj.end_time),
+            date=class_obj.date,
+        )
+
+    def _keys_for(self, class_obj) -> Dict[str, IndexKey]:
+        weekday = self._weekday(class_obj.day_of_week, class_obj.date)
+        return {
+            resource: (class_obj.version_id, resource_id, weekday)
+            for resource, resource_id in self._resource_ids(class_obj).items()
+        }
+
+    def load(self, db: Session):
+        """(Re)build the index from the classes table"""
+        with self._lock:
+            generation = self._generation
+        rows = db.query(
+            models.Class.class_id,
+            models.Class.room_id,
+            models.Class.teacher_id,
+            models.Class.day_of_week,
+            models.Class.date,
+            models.Class.start_time,
+            models.Class.end_time,
+            models.Class.approval_status,
+            models.Class.version_id,
+        ).all()
+        with self._lock:
+            self._indexes = {resource: {} for resource in self.RESOURCES}
+            self._keys = {}
+            for row in rows:
+                self._insert(row)
+            # Rebuilt again on next use if a write landed while loading
+            self._loaded = self._generation == generation
+
+    def ensure_loaded(self, db: Session):
+        if not self._loaded:
+            self.load(db)
+
+    def invalidate(self):
+        """Drop the index; it is rebuilt on next use"""
+        with self._lock:
+            self._generation += 1
+            self._loaded = False
+
+    def write_lock(self, version_id: Optional[int]) -> Lock:
+        """Lock to hold from checking a class write to version_id until it is added"""
+        with self._lock:
+            return self._write_locks.setdefault(version_id, Lock())
+
+    @contextmanager
+    def write_locks(self, version_ids: Iterable[Optional[int]]) -> Iterator[None]:
+        """Hold the write locks of several versions, taken in a fixed order"""
+        with ExitStack() as stack:
+            for version_id in sorted(set(version_ids), key=lambda value: (value is not None, value or 0)):
+                stack.enter_context(self.write_lock(version_id))
+            yield
+
+    def _insert(self, class_obj):
+        if not self._is_indexed(class_obj):
+            return
+        booking = self._booking(class_obj)
+        keys = self._keys_for(class_obj)
+        for resource, key in keys.items():
+            self._indexes[resource].setdefault(key, IntervalIndex()).add(booking)
+        self._keys[booking.class_id] = keys
+
+    def add(self, class_obj):
+        with self._lock:
+            self.remove(class_obj.class_id)
+            self._insert(class_obj)
+
+    def remove(self, class_id: int):
+        with self._lock:
+            keys = self._keys.pop(class_id, None)
+            if keys is None:
+                return
+            for resource, key in keys.items():
+                index = self._indexes[resource].get(key)
+                if index is None:
+                    continue
+                index.remove(class_id)
+                if not len(index):
+                    del self._indexes[resource][key]
+
+    def find_conflicts(self, class_obj) -> List[dict]:
+        """
+        Return every booking that clashes with class_obj, tagged by resource.
+        class_obj may be a transient instance; its own class_id is ignored.
+        """
+        if not self._is_indexed(class_obj):
+            return []
+        booking = self._booking(class_obj)
+        conflicts = []
+        with self._lock:
+            for resource, key in self._keys_for(class_obj).items():
+                index = self._indexes[resource].get(key)
+                if index is None:
+                    continue
+                for other in index.overlapping(booking):
+                    conflicts.append(
+                        {
+                            "resource": resource,
+                            "resource_id": key[1],
+                            "class_id": other.class_id,
+                            "day_of_week": key[2],
+                            "date": other.date,
+                            "start_time": minutes_to_time(other.start),
+                            "end_time": minutes_to_time(other.end),
+                        }
+                    )
+        return conflicts
+
+
+conflict_index = ConflictIndex()
+change_tracker.on_remote_change("classes", conflict_index.invalidate)
+change_tracker.on_remote_change("timetable_versions", conflict_index.invalidate)
+
+
+def sweep_overlaps(items):
+    """
+    Sort-and-sweep over (group, start, end, date, ref) tuples.
+
+    Yields every pair of items in the same group whose times overlap and whose
+    dates are compatible (recurring items match every date on their weekday).
+    """
+    active = []
+    current_group = object()
+    for item in sorted(items, key=lambda item: (item[0], item[1])):
+        group, start, _, on_date, _ = item
+        if group != current_group:
+            current_group = group
+            active = []
+        active = [other for other in active if other[2] > start]
+        for other in active:
+            if on_date is None or other[3] is None or on_date == other[3]:
+                yield other, item
+        active.append(item)
+
+
+def _conflict(kind, resource_id, first, second):
+    return {
+        "kind": kind,
+        "resource_id": resource_id,
+        "class_ids": [ref for ref in (first[4], second[4]) if isinstance(ref, int)],
+        "unavailability_id": next(
+            (ref[1] for ref in (first[4], second[4]) if isinstance(ref, tuple)), None
+        ),
+        "day_of_week": first[0][1],
+        "date": first[3] or second[3],
+        "start_time": minutes_to_time(max(first[1], second[1])),
+        "end_time": minutes_to_time(min(first[2], second[2])),
+    }
+
+
+def find_version_conflicts(db: Session, version_id: int):
+    """
+    Find every room, teacher, class group and teacher unavailability clash in
+    a timetable version.
+
+    Classes, group assignments and unavailabilities are each fetched with a
+    single query; overlaps are then found with one sort-and-sweep pass per
+    resource kind instead of comparing classes pairwise in the database.
+    Returns (class_count, conflicts).
+    """
+    rows = (
+        db.query(
+            models.Class.class_id,
+            models.Class.teacher_id,
+            models.Class.room_id,
+            models.Class.day_of_week,
+            models.Class.date,
+            models.Class.start_time,
+            models.Class.end_time,
+        )
+        .filter(
+            models.Class.version_id == version_id,
+            models.Class.approval_status != models.ApprovalStatus.rejected,
+        )
+        .all()
+    )
+    if not rows:
+        return 0, []
+
+    # Columnar view of the version
+    class_ids, teacher_ids, room_ids, days, dates, starts, ends = zip(*rows)
+    weekdays = [
+        on_date.isoweekday() if on_date is not None else day
+        for day, on_date in zip(days, dates)
+    ]
+    start_minutes = [to_minutes(value) for value in starts]
+    end_minutes = [to_minutes(value) for value in ends]
+    position = {class_id: i for i, class_id in enumerate(class_ids)}
+
+    def items_for(resource_ids):
+        return [
+            ((resource_ids[i], weekdays[i]), start_minutes[i], end_minutes[i], dates[i], class_ids[i])
+            for i in range(len(class_ids))
+            if weekdays[i] is not None
+        ]
+
+    conflicts = []
+    for kind, resource_ids in (("room", room_ids), ("teacher", teacher_ids)):
+        for first, second in sweep_overlaps(items_for(resource_ids)):
+            conflicts.append(_conflict(kind, first[0][0], first, second))
+
+    assignments = (
+        db.query(
+            models.class_group_assignments.c.class_id,
+            models.class_group_assignments.c.class_group_id,
+        )
+        .join(models.Class, models.Class.class_id == models.class_group_assignments.c.class_id)
+        .filter(models.Class.version_id == version_id)
+        .all()
+    )
+    group_items = []
+    for class_id, class_group_id in assignments:
+        i = position.get(class_id)
+        if i is None or weekdays[i] is None:
+            continue
+        group_items.append(
+            ((class_group_id, weekdays[i]), start_minutes[i], end_minutes[i], dates[i], class_id)
+        )
+    for first, second in sweep_overlaps(group_items):
+        conflicts.append(_conflict("class_group", first[0][0], first, second))
+
+    unavailabilities = (
+        db.query(
+            models.Unavailability.unavailability_id,
+            models.Unavailability.teacher_id,
+            models.Unavailability.day_of_week,
+            models.Unavailability.date,
+            models.Unavailability.start_time,
+            models.Unavailability.end_time,
+            models.Unavailability.is_full_day,
+        )
+        .filter(models.Unavailability.teacher_id.in_(set(teacher_ids)))
+        .all()
+    )
+    if unavailabilities:
+        teacher_items = items_for(teacher_ids)
+        for unavailability_id, teacher_id, day, on_date, start, end, is_full_day in unavailabilities:
+            weekday = on_date.isoweekday() if on_date is not None else day
+            if weekday is None:
+                continue
+            if is_full_day or start is None or end is None:
+                start_minute, end_minute = 0, DAY_MINUTES
+            else:
+                start_minute, end_minute = to_minutes(start), to_minutes(end)
+            teacher_items.append(
+                ((teacher_id, weekday), start_minute, end_minute, on_date, ("unavailability", unavailability_id))
+            )
+        for first, second in sweep_overlaps(teacher_items):
+            # Class/class pairs were already reported as teacher conflicts
+            if isinstance(first[4], tuple) == isinstance(second[4], tuple):
+                continue
+            conflicts.append(_conflict("unavailability", first[0][0], first, second))
+
+    return len(rows), conflicts
@@ -1,8 +1,17 @@
-from sqlalchemy import create_engine
+from time import perf_counter
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from dotenv import load_dotenv
 import os
 
+from app.instrumentation import instrument_queries
+from app.metrics import Counter, Gauge, Histogram
+
 # Import the Base from your models
 # from app.models import Base
 
@@ -10,22 +19,179 @@ load_dotenv()
 
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL")
 
-# Create the database engine
-engine = create_engine(SQLALCHEMY_DATABASE_URL, echo=True)
 
-# Create engine
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-    pool_size=10,
-    max_overflow=20,
-    pool_pre_ping=True,  # Verify connections before using
-    echo=False,  # Set to True for SQL query logging
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return default if value in (None, "") else int(value)
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    return default if value in (None, "") else value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# Pool settings, per engine and per uvicorn worker process
+DB_POOL_SIZE = _env_int("DB_POOL_SIZE", 10)
+DB_MAX_OVERFLOW = _env_int("DB_MAX_OVERFLOW", 20)
+DB_POOL_TIMEOUT = _env_int("DB_POOL_TIMEOUT", 30)
+# MariaDB drops connections idle for longer than wait_timeout (28800s by
+# default, often much lower on shared hosts). Recycling well before that
+# avoids handing out a connection the server has already closed.
+DB_POOL_RECYCLE = _env_int("DB_POOL_RECYCLE", 1800)
+DB_POOL_PRE_PING = _env_bool("DB_POOL_PRE_PING", True)
+DB_ECHO = _env_bool("DB_ECHO", False)  # Log every SQL statement
+
+POOL_CHECKOUT_SECONDS = Histogram(
+    "db_pool_checkout_seconds",
+    "Time to get a connection from the pool, including waiting and pre-ping",
+    ["engine"],
+)
+POOL_CHECKOUT_TIMEOUTS = Counter(
+    "db_pool_checkout_timeouts_total", "Checkouts that gave up after DB_POOL_TIMEOUT", ["engine"]
+)
+POOL_OVERFLOW_CHECKOUTS = Counter(
+    "db_pool_overflow_checkouts_total", "Checkouts served while the pool was past pool_size", ["engine"]
 )
+POOL_CONNECTS = Counter("db_pool_connects_total", "New database connections opened", ["engine"])
+POOL_INVALIDATIONS = Counter(
+    "db_pool_invalidations_total", "Connections invalidated (soft: recycled on next checkin)", ["engine", "soft"]
+)
+POOL_PRE_PING_SECONDS = Histogram("db_pool_pre_ping_seconds", "Cost of the pre-ping on checkout", ["engine"])
+
+# engine label -> pool owner, for the gauges below
+_ENGINES = {}
+
+
+def _pool_state():
+    values = {}
+    for name, owner in _ENGINES.items():
+        pool = owner.pool
+        if not isinstance(pool, QueuePool):
+            continue
+        values[(name, "checked_out")] = pool.checkedout()
+        values[(name, "idle")] = pool.checkedin()
+        values[(name, "overflow")] = max(pool.overflow(), 0)
+    return values
+
+
+def _pool_limits():
+    values = {}
+    for name, owner in _ENGINES.items():
+        if isinstance(owner.pool, QueuePool):
+            values[(name, "pool_size")] = owner.pool.size()
+            values[(name, "max_overflow")] = DB_MAX_OVERFLOW
+    return values
+
+
+Gauge("db_pool_connections", "Pooled connections by state", ["engine", "state"], collect=_pool_state)
+Gauge("db_pool_limit", "Configured pool limits", ["engine", "limit"], collect=_pool_limits)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout takes"""
+
+    engine_name = "sync"
+
+    def connect(self):
+        start = perf_counter()
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            POOL_CHECKOUT_TIMEOUTS.inc(engine=self.engine_name)
+            raise
+        finally:
+            POOL_CHECKOUT_SECONDS.observe(perf_counter() - start, engine=self.engine_name)
+
+
+class InstrumentedAsyncQueuePool(InstrumentedQueuePool, AsyncAdaptedQueuePool):
+    engine_name = "async"
+
+
+def instrument_engine(engine: Engine, name: str):
+    """Export connects, invalidations, overflow use and pre-ping cost of an engine's pool"""
+    _ENGINES[name] = engine
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        POOL_CONNECTS.inc(engine=name)
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        pool = engine.pool
+        if isinstance(pool, QueuePool) and pool.overflow() > 0:
+            POOL_OVERFLOW_CHECKOUTS.inc(engine=name)
+
+    @event.listens_for(engine, "invalidate")
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        POOL_INVALIDATIONS.inc(engine=name, soft="false")
+
+    @event.listens_for(engine, "soft_invalidate")
+    def on_soft_invalidate(dbapi_connection, connection_record, exception):
+        POOL_INVALIDATIONS.inc(engine=name, soft="true")
+
+    # The pool pre-pings through dialect.do_ping
+    do_ping = engine.dialect.do_ping
+
+    def timed_ping(dbapi_connection):
+        start = perf_counter()
+        try:
+            return do_ping(dbapi_connection)
+        finally:
+            POOL_PRE_PING_SECONDS.observe(perf_counter() - start, engine=name)
+
+    engine.dialect.do_ping = timed_ping
+
+
+def pool_options() -> dict:
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "echo": DB_ECHO,
+    }
+
+
+# Create engine
+engine = create_engine(SQLALCHEMY_DATABASE_URL, poolclass=InstrumentedQueuePool, **pool_options())
+instrument_engine(engine, "sync")
+instrument_queries(engine)
 
 # Create session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
+def async_database_url(url: str) -> str:
+    """
+    Swap the synchronous driver of a database URL for its asyncio
+    counterpart (pymysql -> aiomysql), unless ASYNC_DATABASE_URL is set.
+    """
+    async_url = os.getenv("ASYNC_DATABASE_URL")
+    if async_url:
+        return async_url
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend in ("mysql", "mariadb"):
+        parsed = parsed.set(drivername=f"{backend}+aiomysql")
+    elif backend == "sqlite":
+        parsed = parsed.set(drivername="sqlite+aiosqlite")
+    return parsed.render_as_string(hide_password=False)
+
+
+# Async engine for the hot read endpoints, so waiting on the database does
+# not hold a threadpool thread. Same pool settings, but a separate pool.
+async_engine = create_async_engine(
+    async_database_url(SQLALCHEMY_DATABASE_URL),
+    poolclass=InstrumentedAsyncQueuePool,
+    **pool_options(),
+)
+instrument_engine(async_engine.sync_engine, "async")
+instrument_queries(async_engine.sync_engine)
+
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+
+
 # Dependency for FastAPI
 def get_session():
     """
@@ -39,6 +205,15 @@ def get_session():
         db.close()
 
 
+async def get_async_session():
+    """
+    Async database session dependency for FastAPI.
+    Usage: db: AsyncSession = Depends(get_async_session)
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
 # Initialize database tables
 def init_db():
     """Create all tables in the database"""
@@ -0,0 +1,150 @@
+"""
+Conditional GET for endpoints the frontend polls.
+
+Every table (or other change scope) has a counter bumped by the write
+handlers. A response's ETag is built from the counters of everything it
+serializes, so an If-None-Match request is answered with 304 before the
+database or the response model is touched.
+
+Counters live in the worker process. ETags carry a per-process id, so a
+tag issued by another worker never matches. With several workers, set
+CACHE_INVALIDATION_URL so bumps reach every worker (see app.cache).
+"""
+import uuid
+import zlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from functools import partial
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+from fastapi import Request, Response
+
+from app.cache import DEPENDENTS, LocalInvalidation, invalidation_backend, reference_cache
+
+PROCESS_ID = uuid.uuid4().hex[:8]
+
+# What each polled response serializes, nested models included
+CLASS_TABLES = (
+    "classes", "users", "class_groups", "timetable_versions", "locations", "schools", "courses", "subjects", "rooms"
+)
+ROOM_TABLES = ("rooms", "locations", "schools", "courses")
+TIMETABLE_EVENT_TABLES = ("timetable_events",)
+
+
+def _now() -> datetime:
+    # HTTP dates have second resolution
+    return datetime.now(timezone.utc).replace(microsecond=0)
+
+
+class ChangeTracker:
+    def __init__(self, backend=None):
+        self._counters: Dict[str, int] = {}
+        self._modified: Dict[str, datetime] = {}
+        self._started = _now()
+        self._lock = Lock()
+        self._listeners: Dict[str, List[Callable[[], None]]] = {}
+        self._remote_listeners: Dict[str, List[Callable[[], None]]] = {}
+        self._backend = backend or LocalInvalidation()
+        self._backend.start(self._received)
+
+    def bump(self, *tables: str):
+        """Record a write to tables, in every worker"""
+        self.changed(tables)
+        self._backend.publish({"origin": PROCESS_ID, "tables": list(tables)})
+
+    def _received(self, message: dict):
+        # The backend echoes this worker's own bumps, which changed() already recorded
+        if message["origin"] == PROCESS_ID:
+            return
+        self.changed(message["tables"])
+        for table in message["tables"]:
+            for callback in self._remote_listeners.get(table, ()):
+                callback()
+
+    def changed(self, tables: Iterable[str]):
+        """Record a write to tables in this worker only"""
+        tables = list(tables)
+        now = _now()
+        with self._lock:
+            for table in tables:
+                self._counters[table] = self._counters.get(table, 0) + 1
+                self._modified[table] = now
+        for table in tables:
+            for callback in self._listeners.get(table, ()):
+                callback()
+
+    def on_change(self, table: str, callback: Callable[[], None]):
+        """Run callback whenever table changes, in this worker or another"""
+        self._listeners.setdefault(table, []).append(callback)
+
+    def on_remote_change(self, table: str, callback: Callable[[], None]):
+        """
+        Run callback whenever another worker changes table. For in-process
+        state the local write handlers already keep up to date themselves.
+        """
+        self._remote_listeners.setdefault(table, []).append(callback)
+
+    def etag(self, tables: Sequence[str], variant: str = "") -> str:
+        with self._lock:
+            counters = ".".join(str(self._counters.get(table, 0)) for table in tables)
+        return f'W/"{PROCESS_ID}-{counters}-{variant}"'
+
+    def last_modified(self, tables: Sequence[str]) -> datetime:
+        with self._lock:
+            return max(self._modified.get(table, self._started) for table in tables)
+
+
+change_tracker = ChangeTracker(invalidation_backend("horarios:table-changes"))
+
+# Reference data writes already go through the reference cache
+for _namespace in DEPENDENTS:
+    reference_cache.on_invalidate(_namespace, partial(change_tracker.changed, (_namespace,)))
+
+
+def _weak(tag: str) -> str:
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def _is_fresh(request: Request, etag: str, last_modified: datetime) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        return _weak(etag) in {_weak(tag) for tag in if_none_match.split(",")}
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def not_modified(
+    request: Request,
+    response: Response,
+    tables: Sequence[str],
+    tracker: ChangeTracker = change_tracker,
+) -> Optional[Response]:
+    """
+    A 304 response if the client's copy is current, otherwise None after
+    setting ETag and Last-Modified on response.
+
+    Usage: cached = not_modified(request, response, CLASS_TABLES)
+           if cached: return cached
+    """
+    # Paths and query parameters select different views of the same tables
+    variant = format(zlib.crc32(f"{request.url.path}?{request.url.query}".encode()), "08x")
+    etag = tracker.etag(tables, variant)
+    last_modified = tracker.last_modified(tables)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified, usegmt=True),
+        "Cache-Control": "no-cache",
+    }
+    if _is_fresh(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
@@ -0,0 +1,133 @@
+"""
+Streaming export of a timetable version.
+
+Rows are flat (ids plus the few names downstream systems need) and come from
+a single server-side cursor read in chunks, so memory use does not grow with
+the size of the version.
+"""
+import csv
+import io
+import json
+from datetime import date, time
+from enum import Enum
+from typing import Iterator
+
+from sqlalchemy import func, select
+
+from app.database import SessionLocal
+from app.models import models
+
+CHUNK_SIZE = 1000
+
+COLUMNS = (
+    "class_id",
+    "version_id",
+    "subject_id",
+    "subject_name",
+    "class_type",
+    "teacher_id",
+    "teacher_username",
+    "room_id",
+    "room_name",
+    "day_of_week",
+    "date",
+    "start_time",
+    "end_time",
+    "is_recurring",
+    "approval_status",
+    "class_group_ids",
+)
+
+
+def _export_statement(version_id: int):
+    assignments = models.class_group_assignments
+    # Only the version's assignments are grouped, not the whole table
+    groups = (
+        select(
+            assignments.c.class_id,
+            func.group_concat(assignments.c.class_group_id).label("class_group_ids"),
+        )
+        .join(models.Class, models.Class.class_id == assignments.c.class_id)
+        .where(models.Class.version_id == version_id)
+        .group_by(assignments.c.class_id)
+        .subquery()
+    )
+    return (
+        select(
+            models.Class.class_id,
+            models.Class.version_id,
+            models.Class.subject_id,
+            models.Subject.name,
+            models.Class.class_type,
+            models.Class.teacher_id,
+            models.User.username,
+            models.Class.room_id,
+            models.Room.name,
+            models.Class.day_of_week,
+            models.Class.date,
+            models.Class.start_time,
+            models.Class.end_time,
+            models.Class.is_recurring,
+            models.Class.approval_status,
+            groups.c.class_group_ids,
+        )
+        .join(models.Subject, models.Subject.subject_id == models.Class.subject_id)
+        .join(models.User, models.User.user_id == models.Class.teacher_id)
+        .join(models.Room, models.Room.room_id == models.Class.room_id)
+        .outerjoin(groups, groups.c.class_id == models.Class.class_id)
+        .where(models.Class.version_id == version_id)
+        .order_by(models.Class.class_id)
+        .execution_options(yield_per=CHUNK_SIZE)
+    )
+
+
+def _plain(value):
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    return value
+
+
+def iter_rows(version_id: int) -> Iterator[dict]:
+    """
+    Flat rows of a version, read through a server-side cursor.
+    Opens its own session since it outlives the request handler.
+    """
+    db = SessionLocal()
+    try:
+        for partition in db.execute(_export_statement(version_id)).partitions():
+            for row in partition:
+                record = dict(zip(COLUMNS, map(_plain, row)))
+                groups = record["class_group_ids"]
+                record["class_group_ids"] = (
+                    sorted(int(group_id) for group_id in str(groups).split(",")) if groups else []
+                )
+                yield record
+    finally:
+        db.close()
+
+
+def iter_ndjson(version_id: int) -> Iterator[str]:
+    lines = []
+    for record in iter_rows(version_id):
+        lines.append(json.dumps(record, separators=(",", ":")))
+        if len(lines) >= CHUNK_SIZE:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def iter_csv(version_id: int) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for count, record in enumerate(iter_rows(version_id), start=1):
+        record["class_group_ids"] = " ".join(map(str, record["class_group_ids"]))
+        writer.writerow(record[column] for column in COLUMNS)
+        if count % CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
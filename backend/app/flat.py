@@ -0,0 +1,100 @@
+"""
+Flat (?view=flat) rendering of list responses.
+
+Nested response models repeat the same school, location or course in every
+row of a page and validate it each time. The flat view returns every row
+with its own fields and foreign key ids only, plus a side table with each
+referenced entity once, keyed by table and primary key:
+
+    {"items": [{"class_id": 1, "subject_id": 7, ..., "class_group_ids": [3]}],
+     "included": {"subjects": {"7": {...}}, "courses": {...}, ...}}
+
+Which fields and relationships are emitted follows the nested response
+schema, so the flat view never exposes more than the nested one. Rows are
+plain dicts rendered by orjson, skipping Pydantic altogether; endpoints
+declare both shapes with list_or_flat so the OpenAPI schema covers the
+flat one too.
+"""
+from functools import lru_cache
+from typing import Annotated, Any, Dict, List, Optional, Tuple, Union
+
+import orjson
+from fastapi import Response
+from pydantic import BaseModel, Field
+from sqlalchemy import inspect
+
+from app.loading import MAX_DEPTH, nested_schema
+
+# (scalar fields, [(relationship, nested schema, related model, is a collection)], primary key)
+Plan = Tuple[Tuple[str, ...], Tuple[tuple, ...], str]
+
+
+class FlatPage(BaseModel):
+    """Body of a ?view=flat response"""
+    items: List[Dict[str, Any]]
+    # table -> primary key -> row
+    included: Dict[str, Dict[str, Dict[str, Any]]]
+
+
+def list_or_flat(schema):
+    """response_model of a list endpoint with ?view=flat: a list of schema or a FlatPage"""
+    # The nested list is tried first, so the default view validates as before
+    return Annotated[Union[List[schema], FlatPage], Field(union_mode="left_to_right")]
+
+
+class ORJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+@lru_cache(maxsize=None)
+def _plan(model, schema) -> Plan:
+    relationships = inspect(model).relationships
+    scalars, nested = [], []
+    for name, field in schema.model_fields.items():
+        child = nested_schema(field.annotation)
+        if child is not None and name in relationships:
+            relationship = relationships[name]
+            nested.append((name, child, relationship.mapper.class_, relationship.uselist))
+        else:
+            scalars.append(name)
+    return tuple(scalars), tuple(nested), inspect(model).primary_key[0].key
+
+
+class _Flattener:
+    def __init__(self):
+        self.included: Dict[str, Dict[int, dict]] = {}
+
+    def row(self, obj, model, schema, depth: int = 0) -> dict:
+        scalars, nested, _ = _plan(model, schema)
+        row = {name: getattr(obj, name) for name in scalars}
+        for name, nested_schema, related_model, uselist in nested:
+            value = getattr(obj, name)
+            if uselist:
+                key = _plan(related_model, nested_schema)[2]
+                row[f"{key}s"] = [getattr(item, key) for item in value]
+                for item in value:
+                    self.include(item, related_model, nested_schema, depth + 1)
+            elif value is not None:
+                self.include(value, related_model, nested_schema, depth + 1)
+        return row
+
+    def include(self, obj, model, schema, depth: int):
+        table = self.included.setdefault(model.__tablename__, {})
+        key = getattr(obj, _plan(model, schema)[2])
+        if key not in table and depth <= MAX_DEPTH:
+            table[key] = self.row(obj, model, schema, depth)
+
+
+def flat_response(items, model, schema, response: Optional[Response] = None) -> ORJSONResponse:
+    """Flat rendering of a list of model (or schema) instances; keeps headers set on response"""
+    flattener = _Flattener()
+    rows: List[dict] = [flattener.row(item, model, schema) for item in items]
+    flat = ORJSONResponse({"items": rows, "included": flattener.included})
+    if response is not None:
+        for name, value in response.headers.items():
+            if name.lower() not in ("content-length", "content-type"):
+                flat.headers[name] = value
+    return flat
@@ -0,0 +1,172 @@
+"""
+iCalendar (RFC 5545) feeds of a teacher's, room's or class group's classes.
+
+A recurring class becomes one VEVENT with a weekly RRULE over the academic
+year and an EXDATE for every holiday or break it falls on; a one-off class
+becomes a single VEVENT. Times are floating (local wall-clock) times.
+
+Calendar apps poll feeds every few minutes, so rendered feeds are cached
+per resource and window and only rebuilt after a write to something they
+show (classes, calendar events, subject, room or user names).
+"""
+from datetime import date, datetime, timedelta
+from typing import Iterator, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from app.cache import MISSING, TTLCache
+from app.etags import change_tracker
+from app.models import models
+from app.occurrences import DateRangeIndex, closed_days
+from app.schemas import classes as schemas
+
+# What a feed shows; its ETag and cache follow these tables
+FEED_TABLES = ("classes", "calendar_events", "subjects", "rooms", "users", "class_groups", "timetable_versions")
+CACHED_FEEDS = 4096
+ACADEMIC_YEAR_START_MONTH = 9
+PRODID = "-//IPT//Horarios//PT"
+
+FEED_KINDS = {
+    "user": models.User,
+    "room": models.Room,
+    "class_group": models.ClassGroup,
+}
+
+
+def academic_year(today: date) -> Tuple[date, date]:
+    """First and last day of the academic year (September to August) containing today"""
+    year = today.year if today.month >= ACADEMIC_YEAR_START_MONTH else today.year - 1
+    start = date(year, ACADEMIC_YEAR_START_MONTH, 1)
+    return start, date(year + 1, ACADEMIC_YEAR_START_MONTH, 1) - timedelta(days=1)
+
+
+def _escape(text: str) -> str:
+    return (
+        str(text).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+    )
+
+
+def _fold(line: str) -> str:
+    """Split a content line into chunks of at most 75 octets (RFC 5545 3.1)"""
+    encoded = line.encode()
+    if len(encoded) <= 75:
+        return line + "\r\n"
+    parts, current, size = [], "", 0
+    for char in line:
+        width = len(char.encode())
+        if size + width > (75 if not parts else 74):
+            parts.append(current)
+            current, size = "", 0
+        current += char
+        size += width
+    parts.append(current)
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def _stamp(value: datetime) -> str:
+    return value.strftime("%Y%m%dT%H%M%S")
+
+
+def _feed_statement(kind: str, resource_id: int, version_id: Optional[int]):
+    statement = (
+        select(models.Class, models.Subject.name, models.Room.name, models.User.username)
+        .join(models.Subject, models.Subject.subject_id == models.Class.subject_id)
+        .join(models.Room, models.Room.room_id == models.Class.room_id)
+        .join(models.User, models.User.user_id == models.Class.teacher_id)
+        .where(models.Class.approval_status != schemas.ApprovalStatus.rejected)
+        .order_by(models.Class.class_id)
+    )
+    if kind == "user":
+        statement = statement.where(models.Class.teacher_id == resource_id)
+    elif kind == "room":
+        statement = statement.where(models.Class.room_id == resource_id)
+    else:
+        assignments = models.class_group_assignments
+        statement = statement.where(
+            models.Class.class_id.in_(
+                select(assignments.c.class_id).where(assignments.c.class_group_id == resource_id)
+            )
+        )
+    if version_id is not None:
+        statement = statement.where(models.Class.version_id == version_id)
+    return statement
+
+
+def _event_lines(
+    db_class, subject: str, room: str, teacher: str, start: date, end: date, closed: DateRangeIndex, stamp: str
+) -> Iterator[str]:
+    if db_class.date is not None:
+        if not start <= db_class.date <= end:
+            return
+        first = db_class.date
+    else:
+        # First matching weekday of the window
+        first = start + timedelta(days=(db_class.day_of_week - start.isoweekday()) % 7)
+        if first > end:
+            return
+    yield "BEGIN:VEVENT"
+    yield f"UID:class-{db_class.class_id}@horarios-ipt"
+    yield f"DTSTAMP:{stamp}"
+    yield f"DTSTART:{_stamp(datetime.combine(first, db_class.start_time))}"
+    yield f"DTEND:{_stamp(datetime.combine(first, db_class.end_time))}"
+    if db_class.date is None:
+        yield f"RRULE:FREQ=WEEKLY;UNTIL={_stamp(datetime.combine(end, datetime.max.time()))}"
+        day = first
+        while day <= end:
+            if closed.covers(day):
+                yield f"EXDATE:{_stamp(datetime.combine(day, db_class.start_time))}"
+            day += timedelta(days=7)
+    yield f"SUMMARY:{_escape(f'{subject} ({db_class.class_type.value})')}"
+    yield f"LOCATION:{_escape(room)}"
+    yield f"DESCRIPTION:{_escape(f'Teacher: {teacher}')}"
+    pending = db_class.approval_status == schemas.ApprovalStatus.pending
+    yield f"STATUS:{'TENTATIVE' if pending else 'CONFIRMED'}"
+    yield "END:VEVENT"
+
+
+def iter_feed(
+    db: Session, kind: str, resource_id: int, version_id: Optional[int], start: date, end: date
+) -> Iterator[str]:
+    """Folded content lines of the feed"""
+    closed = closed_days(db)
+    # DTSTAMP must be stable for a feed to be cacheable
+    stamp = change_tracker.last_modified(FEED_TABLES).strftime("%Y%m%dT%H%M%SZ")
+    yield _fold("BEGIN:VCALENDAR")
+    yield _fold("VERSION:2.0")
+    yield _fold(f"PRODID:{PRODID}")
+    yield _fold("CALSCALE:GREGORIAN")
+    yield _fold("METHOD:PUBLISH")
+    for db_class, subject, room, teacher in db.execute(_feed_statement(kind, resource_id, version_id)):
+        for line in _event_lines(db_class, subject, room, teacher, start, end, closed, stamp):
+            yield _fold(line)
+    yield _fold("END:VCALENDAR")
+
+
+class FeedCache:
+    def __init__(self):
+        self._feeds = TTLCache(CACHED_FEEDS, float("inf"))
+
+    def invalidate(self):
+        self._feeds.clear()
+
+    def get(
+        self, db: Session, kind: str, resource_id: int, version_id: Optional[int], start: date, end: date
+    ) -> Optional[bytes]:
+        """The rendered feed, or None if the resource does not exist"""
+        key = (kind, resource_id, version_id, start, end)
+        feed = self._feeds.get(key)
+        if feed is MISSING:
+            if db.get(FEED_KINDS[kind], resource_id) is None:
+                return None
+            generation = change_tracker.etag(FEED_TABLES)
+            feed = "".join(iter_feed(db, kind, resource_id, version_id, start, end)).encode()
+            # Not stored if something changed while rendering
+            if change_tracker.etag(FEED_TABLES) == generation:
+                self._feeds.set(key, feed)
+        return feed
+
+
+feed_cache = FeedCache()
+for _table in FEED_TABLES:
+    change_tracker.on_change(_table, feed_cache.invalidate)
@@ -0,0 +1,175 @@
+"""
+Per-request latency breakdown.
+
+For every request the middleware records total latency, time spent in the
+database, the number of statements and rows, and the time FastAPI spends
+turning the endpoint's return value into a response (validation against
+response_model plus JSON encoding). Measurements are tagged with the route
+template (/classes/{class_id}, not /classes/42), exported as histograms on
+/metrics and returned in a Server-Timing header, so an N+1 regression shows
+up as a jump in statements per request.
+"""
+import functools
+import inspect
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Callable, Optional
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.metrics import Counter, Histogram
+
+STATEMENT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000)
+ROW_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+REQUESTS = Counter("http_requests_total", "HTTP requests", ["method", "route", "status"])
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Total request latency", ["method", "route"])
+DB_SECONDS = Histogram("http_request_db_seconds", "Time spent executing SQL per request", ["method", "route"])
+DB_STATEMENTS = Histogram(
+    "http_request_db_statements", "SQL statements executed per request", ["method", "route"], STATEMENT_BUCKETS
+)
+DB_ROWS = Histogram(
+    "http_request_db_rows", "Rows returned or affected per request, where the driver reports them",
+    ["method", "route"], ROW_BUCKETS,
+)
+SERIALIZE_SECONDS = Histogram(
+    "http_request_serialize_seconds", "Time building the response from the endpoint's return value",
+    ["method", "route"],
+)
+
+
+class RequestStats:
+    __slots__ = ("route", "db_seconds", "statements", "rows", "endpoint_done", "serialize_seconds")
+
+    def __init__(self):
+        self.route: Optional[str] = None
+        self.db_seconds = 0.0
+        self.statements = 0
+        self.rows = 0
+        self.endpoint_done: Optional[float] = None
+        self.serialize_seconds = 0.0
+
+
+_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def current_stats() -> Optional[RequestStats]:
+    return _stats.get()
+
+
+def instrument_queries(engine: Engine):
+    """Add the statements run on engine to the current request's stats"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        stats = _finish_statement(conn)
+        if stats is not None and cursor.rowcount and cursor.rowcount > 0:
+            stats.rows += cursor.rowcount
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # A failed statement never reaches after_cursor_execute
+        if context.connection is not None and context.connection.info.get("query_start"):
+            _finish_statement(context.connection)
+
+
+def _finish_statement(conn) -> Optional[RequestStats]:
+    """Pop the statement's start time and add it to the request's stats"""
+    elapsed = perf_counter() - conn.info["query_start"].pop()
+    stats = _stats.get()
+    if stats is not None:
+        stats.db_seconds += elapsed
+        stats.statements += 1
+    return stats
+
+
+def _timed_endpoint(endpoint: Callable) -> Callable:
+    """Mark when the endpoint returns; the rest of the handler is response building"""
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def timed(*args, **kwargs):
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                _mark_endpoint_done()
+    else:
+        @functools.wraps(endpoint)
+        def timed(*args, **kwargs):
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                _mark_endpoint_done()
+    return timed
+
+
+def _mark_endpoint_done():
+    stats = _stats.get()
+    if stats is not None:
+        stats.endpoint_done = perf_counter()
+
+
+class InstrumentedRoute(APIRoute):
+    """APIRoute that reports its path template and response building time"""
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        super().__init__(path, _timed_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def instrumented_handler(request):
+            stats = _stats.get()
+            if stats is not None:
+                stats.route = self.path
+            response = await handler(request)
+            if stats is not None and stats.endpoint_done is not None:
+                stats.serialize_seconds = perf_counter() - stats.endpoint_done
+            return response
+
+        return instrumented_handler
+
+
+class InstrumentationMiddleware:
+    """Pure ASGI middleware, so streaming responses are not buffered"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats()
+        token = _stats.set(stats)
+        start = perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                total = (perf_counter() - start) * 1000
+                timing = (
+                    f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.statements} statements", '
+                    f"serialize;dur={stats.serialize_seconds * 1000:.1f}, "
+                    f"total;dur={total:.1f}"
+                )
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", timing.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _stats.reset(token)
+            labels = {"method": scope["method"], "route": stats.route or "unmatched"}
+            REQUESTS.inc(status=str(status), **labels)
+            REQUEST_SECONDS.observe(perf_counter() - start, **labels)
+            DB_SECONDS.observe(stats.db_seconds, **labels)
+            DB_STATEMENTS.observe(stats.statements, **labels)
+            DB_ROWS.observe(stats.rows, **labels)
+            SERIALIZE_SECONDS.observe(stats.serialize_seconds, **labels)
@@ -0,0 +1,63 @@
+"""
+Eager-loading plans derived from response schemas.
+
+Serializing a nested response model such as schemas.Class walks relationships
+(subject -> course -> school -> location, room -> owner_course, ...). With the
+default lazy relationships that costs a SELECT per object and level. The
+loader options built here follow the schema's shape instead: many-to-one
+relationships are joined into the main query and collections are fetched
+with one extra SELECT ... IN per level, so the query count per request no
+longer depends on the number of rows.
+"""
+from functools import lru_cache
+from typing import List, Optional, Tuple, Union, get_args, get_origin
+
+from pydantic import BaseModel
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, selectinload
+
+MAX_DEPTH = 6
+
+
+def nested_schema(annotation) -> Optional[type]:
+    """The BaseModel inside Optional[...] / List[...] annotations, if any"""
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return annotation
+    if get_origin(annotation) in (Union, list, List):
+        for arg in get_args(annotation):
+            nested = nested_schema(arg)
+            if nested is not None:
+                return nested
+    return None
+
+
+def _plan(model, schema, parent, depth: int) -> List:
+    if depth > MAX_DEPTH:
+        return []
+    relationships = inspect(model).relationships
+    options = []
+    for name, field in schema.model_fields.items():
+        nested = nested_schema(field.annotation)
+        if nested is None or name not in relationships:
+            continue
+        relationship = relationships[name]
+        attribute = getattr(model, name)
+        if parent is None:
+            loader = selectinload(attribute) if relationship.uselist else joinedload(attribute)
+        elif relationship.uselist:
+            loader = parent.selectinload(attribute)
+        else:
+            loader = parent.joinedload(attribute)
+        children = _plan(relationship.mapper.class_, nested, loader, depth + 1)
+        options.extend(children or [loader])
+    return options
+
+
+@lru_cache(maxsize=None)
+def load_options(model, schema) -> Tuple:
+    """
+    Loader options that fetch everything schema serializes from model.
+
+    Usage: db.query(models.Class).options(*load_options(models.Class, schemas.Class))
+    """
+    return tuple(_plan(model, schema, None, 0))
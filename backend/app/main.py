@@ -1,15 +1,48 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from typing import List
-from datetime import datetime
+from typing import List, Literal, Optional
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import date, datetime, time
 
 from app.routes import auth
 from app.routes import classes
 from app.routes import timetable
-from app.database import get_session, init_db
+from app.routes import imports
+from app.database import get_async_session, get_session, init_db
 from app.models import models
 from app.schemas import classes as schemas
 from app.utils import get_password_hash
+from app.versions import clone_classes, current_version_id, is_id_collision
+from app.analytics import version_stats
+from app.cache import MISSING, reference_cache
+from app.capacity import capacity_index, find_version_overcapacity
+from app.conflicts import conflict_index, find_version_conflicts
+from app.etags import CLASS_TABLES, ROOM_TABLES, change_tracker, not_modified
+from app.ics import FEED_TABLES, academic_year, feed_cache
+from app.flat import flat_response, list_or_flat
+from app.export import iter_csv, iter_ndjson
+from app.instrumentation import InstrumentationMiddleware, InstrumentedRoute
+from app.loading import load_options
+from app.metrics import render_metrics
+from app.pagination import NEXT_CURSOR_HEADER, paginate, paginate_async
+from app.occupancy import room_index
+from app.occurrences import MAX_OCCURRENCE_DAYS, occurrence_engine
+from app.solver import (
+    build_classes,
+    build_problem,
+    build_repair_problem,
+    get_solver_pool,
+    repair,
+    repair_changes,
+    solve,
+    SOLVER_TIMEOUT,
+    UNIT_MINUTES,
+)
 from fastapi.middleware.cors import CORSMiddleware
 
 
@@ -26,6 +59,10 @@ app = FastAPI(
     description="Sistema de criação de horários",
     version="0.1.0",
 )
+app.router.route_class = InstrumentedRoute
+
+# Opt-in compact rendering of list endpoints, see app.flat
+View = Literal["flat"]
 
 app.add_middleware(
     CORSMiddleware,
@@ -33,7 +70,10 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],  # Explicitly include OPTIONS
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
+# Outermost, so its latency covers the other middleware too
+app.add_middleware(InstrumentationMiddleware)
 
 
 # Run once to init database
@@ -42,6 +82,12 @@ app.add_middleware(
 app.include_router(auth.router)
 app.include_router(classes.router)
 app.include_router(timetable.router)
+app.include_router(imports.router)
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def metrics():
+    """Process metrics (requests, connection pools, caches, ...) in the Prometheus text format"""
+    return render_metrics()
 
 @app.post("/locations/", response_model=schemas.Location)
 def create_location(location: schemas.LocationCreate, db: Session = Depends(get_session)):
@@ -49,16 +95,22 @@ def create_location(location: schemas.LocationCreate, db: Session = Depends(get_
     db.add(db_location)
     db.commit()
     db.refresh(db_location)
+    reference_cache.invalidate("locations")
     return db_location
 
 @app.get("/locations/", response_model=List[schemas.Location])
-def read_locations(skip: int = 0, limit: int = 100, db: Session = Depends(get_session)):
-    locations = db.query(models.Location).offset(skip).limit(limit).all()
-    return locations
+def read_locations(response: Response, skip: int = 0, limit: int = 100, after: Optional[str] = None, db: Session = Depends(get_session)):
+    def load():
+        query = db.query(models.Location).options(*load_options(models.Location, schemas.Location))
+        return [schemas.Location.model_validate(location) for location in paginate(query, models.Location.location_id, response, after, skip, limit)]
+    return reference_cache.page("locations", response, after, skip, limit, load)
 
 @app.get("/locations/{location_id}", response_model=schemas.Location)
 def read_location(location_id: int, db: Session = Depends(get_session)):
-    location = db.query(models.Location).filter(models.Location.location_id == location_id).first()
+    def load():
+        location = db.query(models.Location).options(*load_options(models.Location, schemas.Location)).filter(models.Location.location_id == location_id).first()
+        return None if location is None else schemas.Location.model_validate(location)
+    location = reference_cache.load("locations", location_id, load)
     if location is None:
         raise HTTPException(status_code=404, detail="Location not found")
     return location
@@ -75,6 +127,7 @@ def update_location(location_id: int, location: schemas.LocationUpdate, db: Sess
     
     db.commit()
     db.refresh(db_location)
+    reference_cache.invalidate("locations")
     return db_location
 
 @app.delete("/locations/{location_id}")
@@ -84,6 +137,7 @@ def delete_location(location_id: int, db: Session = Depends(get_session)):
         raise HTTPException(status_code=404, detail="Location not found")
     db.delete(location)
     db.commit()
+    reference_cache.invalidate("locations")
     return {"message": "Location deleted successfully"}
 
 # School endpoints
@@ -93,16 +147,22 @@ def create_school(school: schemas.SchoolCreate, db: Session = Depends(get_sessio
     db.add(db_school)
     db.commit()
     db.refresh(db_school)
+    reference_cache.invalidate("schools")
     return db_school
 
 @app.get("/schools/", response_model=List[schemas.School])
-def read_schools(skip: int = 0, limit: int = 100, db: Session = Depends(get_session)):
-    schools = db.query(models.School).offset(skip).limit(limit).all()
-    return schools
+def read_schools(response: Response, skip: int = 0, limit: int = 100, after: Optional[str] = None, db: Session = Depends(get_session)):
+    def load():
+        query = db.query(models.School).options(*load_options(models.School, schemas.School))
+        return [schemas.School.model_validate(school) for school in paginate(query, models.School.school_id, response, after, skip, limit)]
+    return reference_cache.page("schools", response, after, skip, limit, load)
 
 @app.get("/schools/{school_id}", response_model=schemas.School)
 def read_school(school_id: int, db: Session = Depends(get_session)):
-    school = db.query(models.School).filter(models.School.school_id == school_id).first()
+    def load():
+        school = db.query(models.School).options(*load_options(models.School, schemas.School)).filter(models.School.school_id == school_id).first()
+        return None if school is None else schemas.School.model_validate(school)
+    school = reference_cache.load("schools", school_id, load)
     if school is None:
         raise HTTPException(status_code=404, detail="School not found")
     return school
@@ -119,6 +179,7 @@ def update_school(school_id: int, school: schemas.SchoolUpdate, db: Session = De
     
     db.commit()
     db.refresh(db_school)
+    reference_cache.invalidate("schools")
     return db_school
 
 @app.delete("/schools/{school_id}")
@@ -128,6 +189,7 @@ def delete_school(school_id: int, db: Session = Depends(get_session)):
         raise HTTPException(status_code=404, detail="School not found")
     db.delete(school)
     db.commit()
+    reference_cache.invalidate("schools")
     return {"message": "School deleted successfully"}
 
 # User endpoints
@@ -146,11 +208,15 @@ def create_user(user: schemas.UserCreate, db: Session = Depends(get_session)):
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    change_tracker.bump("users")
     return db_user
 
-@app.get("/users/", response_model=List[schemas.User])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_session)):
-    users = db.query(models.User).offset(skip).limit(limit).all()
+@app.get("/users/", response_model=list_or_flat(schemas.User))
+def read_users(response: Response, skip: int = 0, limit: int = 100, after: Optional[str] = None, view: Optional[View] = None, db: Session = Depends(get_session)):
+    query = db.query(models.User).options(*load_options(models.User, schemas.User))
+    users = paginate(query, models.User.user_id, response, after, skip, limit)
+    if view == "flat":
+        return flat_response(users, models.User, schemas.User, response)
     return users
 
 @app.get("/users/{user_id}", response_model=schemas.User)
@@ -175,6 +241,8 @@ def update_user(user_id: int, user: schemas.UserUpdate, db: Session = Depends(ge
     
     db.commit()
     db.refresh(db_user)
+    change_tracker.bump("users")
+    auth.principal_cache.invalidate(user_id)
     return db_user
 
 @app.delete("/users/{user_id}")
@@ -184,6 +252,8 @@ def delete_user(user_id: int, db: Session = Depends(get_session)):
         raise HTTPException(status_code=404, detail="User not found")
     db.delete(user)
     db.commit()
+    change_tracker.bump("users")
+    auth.principal_cache.invalidate(user_id)
     return {"message": "User deleted successfully"}
 
 # Course endpoints
@@ -193,16 +263,22 @@ def create_course(course: schemas.CourseCreate, db: Session = Depends(get_sessio
     db.add(db_course)
     db.commit()
     db.refresh(db_course)
+    reference_cache.invalidate("courses")
     return db_course
 
 @app.get("/courses/", response_model=List[schemas.Course])
-def read_courses(skip: int = 0, limit: int = 100, db: Session = Depends(get_session)):
-    courses = db.query(models.Course).offset(skip).limit(limit).all()
-    return courses
+def read_courses(response: Response, skip: int = 0, limit: int = 100, after: Optional[str] = None, db: Session = Depends(get_session)):
+    def load():
+        query = db.query(models.Course).options(*load_options(models.Course, schemas.Course))
+        return [schemas.Course.model_validate(course) for course in paginate(query, models.Course.course_id, response, after, skip, limit)]
+    return reference_cache.page("courses", response, after, skip, limit, load)
 
 @app.get("/courses/{course_id}", response_model=schemas.Course)
 def read_course(course_id: int, db: Session = Depends(get_session)):
-    course = db.query(models.Course).filter(models.Course.course_id == course_id).first()
+    def load():
+        course = db.query(models.Course).options(*load_options(models.Course, schemas.Course)).filter(models.Course.course_id == course_id).first()
+        return None if course is None else schemas.Course.model_validate(course)
+    course = reference_cache.load("courses", course_id, load)
     if course is None:
         raise HTTPException(status_code=404, detail="Course not found")
     return course
@@ -219,6 +295,7 @@ def update_course(course_id: int, course: schemas.CourseUpdate, db: Session = De
     
     db.commit()
     db.refresh(db_course)
+    reference_cache.invalidate("courses")
     return db_course
 
 @app.delete("/courses/{course_id}")
@@ -228,6 +305,7 @@ def delete_course(course_id: int, db: Session = Depends(get_session)):
         raise HTTPException(status_code=404, detail="Course not found")
     db.delete(course)
     db.commit()
+    reference_cache.invalidate("courses")
     return {"message": "Course deleted successfully"}
 
 # Subject endpoints
@@ -237,16 +315,22 @@ def create_subject(subject: schemas.SubjectCreate, db: Session = Depends(get_ses
     db.add(db_subject)
     db.commit()
     db.refresh(db_subject)
+    reference_cache.invalidate("subjects")
     return db_subject
 
 @app.get("/subjects/", response_model=List[schemas.Subject])
-def read_subjects(skip: int = 0, limit: int = 100, db: Session = Depends(get_session)):
-    subjects = db.query(models.Subject).offset(skip).limit(limit).all()
-    return subjects
+def read_subjects(response: Response, skip: int = 0, limit: int = 100, after: Optional[str] = None, db: Session = Depends(get_session)):
+    def load():
+        query = db.query(models.Subject).options(*load_options(models.Subject, schemas.Subject))
+        return [schemas.Subject.model_validate(subject) for subject in paginate(query, models.Subject.subject_id, response, after, skip, limit)]
+    return reference_cache.page("subjects", response, after, skip, limit, load)
 
 @app.get("/subjects/{subject_id}", response_model=schemas.Subject)
 def read_subject(subject_id: int, db: Session = Depends(get_session)):
-    subject = db.query(models.Subject).filter(models.Subject.subject_id == subject_id).first()
+    def load():
+        subject = db.query(models.Subject).options(*load_options(models.Subject, schemas.Subject)).filter(models.Subject.subject_id == subject_id).first()
+        return None if subject is None else schemas.Subject.model_validate(subject)
+    subject = reference_cache.load("subjects", subject_id, load)
     if subject is None:
         raise HTTPException(status_code=404, detail="Subject not found")
     return subject
@@ -263,6 +347,7 @@ def update_subject(subject_id: int, subject: schemas.SubjectUpdate, db: Session
     
     db.commit()
     db.refresh(db_subject)
+    reference_cache.invalidate("subjects")
     return db_subject
 
 @app.delete("/subjects/{subject_id}")
@@ -272,6 +357,7 @@ def delete_subject(subject_id: int, db: Session = Depends(get_session)):
         raise HTTPException(status_code=404, detail="Subject not found")
     db.delete(subject)
     db.commit()
+    reference_cache.invalidate("subjects")
     return {"message": "Subject deleted successfully"}
 
 # ClassGroup endpoints
@@ -281,11 +367,15 @@ def create_class_group(class_group: schemas.ClassGroupCreate, db: Session = Depe
     db.add(db_class_group)
     db.commit()
     db.refresh(db_class_group)
+    change_tracker.bump("class_groups")
     return db_class_group
 
-@app.get("/class-groups/", response_model=List[schemas.ClassGroup])
-def read_class_groups(skip: int = 0, limit: int = 100, db: Session = Depends(get_session)):
-    class_groups = db.query(models.ClassGroup).offset(skip).limit(limit).all()
+@app.get("/class-groups/", response_model=list_or_flat(schemas.ClassGroup))
+def read_class_groups(response: Response, skip: int = 0, limit: int = 100, after: Optional[str] = None, view: Optional[View] = None, db: Session = Depends(get_session)):
+    query = db.query(models.ClassGroup).options(*load_options(models.ClassGroup, schemas.ClassGroup))
+    class_groups = paginate(query, models.ClassGroup.class_group_id, response, after, skip, limit)
+    if view == "flat":
+        return flat_response(class_groups, models.ClassGroup, schemas.ClassGroup, response)
     return class_groups
 
 @app.get("/class-groups/{class_group_id}", response_model=schemas.ClassGroup)
@@ -307,6 +397,7 @@ def update_class_group(class_group_id: int, class_group: schemas.ClassGroupUpdat
     
     db.commit()
     db.refresh(db_class_group)
+    change_tracker.bump("class_groups")
     return db_class_group
 
 @app.delete("/class-groups/{class_group_id}")
@@ -316,6 +407,7 @@ def delete_class_group(class_group_id: int, db: Session = Depends(get_session)):
         raise HTTPException(status_code=404, detail="Class group not found")
     db.delete(class_group)
     db.commit()
+    change_tracker.bump("class_groups")
     return {"message": "Class group deleted successfully"}
 
 # Room endpoints
@@ -325,16 +417,54 @@ def create_room(room: schemas.RoomCreate, db: Session = Depends(get_session)):
     db.add(db_room)
     db.commit()
     db.refresh(db_room)
+    reference_cache.invalidate("rooms")
     return db_room
 
 @app.get("/rooms/", response_model=List[schemas.Room])
-def read_rooms(skip: int = 0, limit: int = 100, db: Session = Depends(get_session)):
-    rooms = db.query(models.Room).offset(skip).limit(limit).all()
-    return rooms
+async def read_rooms(request: Request, response: Response, skip: int = 0, limit: int = 100, after: Optional[str] = None, db: AsyncSession = Depends(get_async_session)):
+    cached = not_modified(request, response, ROOM_TABLES)
+    if cached:
+        return cached
+    async def load():
+        statement = select(models.Room).options(*load_options(models.Room, schemas.Room))
+        rooms = await paginate_async(db, statement, models.Room.room_id, response, after, skip, limit)
+        return [schemas.Room.model_validate(room) for room in rooms]
+    return await reference_cache.page_async("rooms", response, after, skip, limit, load)
+
+@app.get("/rooms/available", response_model=List[schemas.Room])
+def read_available_rooms(
+    start_time: time,
+    end_time: time,
+    day_of_week: Optional[int] = None,
+    date: Optional[date] = None,
+    location_id: Optional[int] = None,
+    min_capacity: int = 0,
+    version_id: Optional[int] = None,
+    db: Session = Depends(get_session),
+):
+    """Get the rooms free in a time window, smallest sufficient capacity first (current version unless version_id is given)"""
+    if (day_of_week is None) == (date is None):
+        raise HTTPException(status_code=400, detail="Provide either day_of_week or date")
+    if day_of_week is not None and not 1 <= day_of_week <= 7:
+        raise HTTPException(status_code=400, detail="day_of_week must be between 1 and 7")
+    if start_time >= end_time:
+        raise HTTPException(status_code=400, detail="start_time must be before end_time")
+    if version_id is None:
+        version_id = current_version_id(db)
+    return room_index.find(db, start_time, end_time, day_of_week, date, location_id, min_capacity, version_id)
 
 @app.get("/rooms/{room_id}", response_model=schemas.Room)
-def read_room(room_id: int, db: Session = Depends(get_session)):
-    room = db.query(models.Room).filter(models.Room.room_id == room_id).first()
+async def read_room(room_id: int, db: AsyncSession = Depends(get_async_session)):
+    room = reference_cache.get("rooms", room_id)
+    if room is MISSING:
+        generation = reference_cache.generation("rooms")
+        result = await db.execute(
+            select(models.Room).options(*load_options(models.Room, schemas.Room)).where(models.Room.room_id == room_id)
+        )
+        room = result.scalar_one_or_none()
+        if room is not None:
+            room = schemas.Room.model_validate(room)
+            reference_cache.set("rooms", room_id, room, generation)
     if room is None:
         raise HTTPException(status_code=404, detail="Room not found")
     return room
@@ -351,6 +481,7 @@ def update_room(room_id: int, room: schemas.RoomUpdate, db: Session = Depends(ge
     
     db.commit()
     db.refresh(db_room)
+    reference_cache.invalidate("rooms")
     return db_room
 
 @app.delete("/rooms/{room_id}")
@@ -360,6 +491,7 @@ def delete_room(room_id: int, db: Session = Depends(get_session)):
         raise HTTPException(status_code=404, detail="Room not found")
     db.delete(room)
     db.commit()
+    reference_cache.invalidate("rooms")
     return {"message": "Room deleted successfully"}
 
 # TimetableVersion endpoints
@@ -369,11 +501,15 @@ def create_timetable_version(version: schemas.TimetableVersionCreate, db: Sessio
     db.add(db_version)
     db.commit()
     db.refresh(db_version)
+    change_tracker.bump("timetable_versions")
     return db_version
 
-@app.get("/timetable-versions/", response_model=List[schemas.TimetableVersion])
-def read_timetable_versions(skip: int = 0, limit: int = 100, db: Session = Depends(get_session)):
-    versions = db.query(models.TimetableVersion).offset(skip).limit(limit).all()
+@app.get("/timetable-versions/", response_model=list_or_flat(schemas.TimetableVersion))
+def read_timetable_versions(response: Response, skip: int = 0, limit: int = 100, after: Optional[str] = None, view: Optional[View] = None, db: Session = Depends(get_session)):
+    query = db.query(models.TimetableVersion).options(*load_options(models.TimetableVersion, schemas.TimetableVersion))
+    versions = paginate(query, models.TimetableVersion.version_id, response, after, skip, limit)
+    if view == "flat":
+        return flat_response(versions, models.TimetableVersion, schemas.TimetableVersion, response)
     return versions
 
 @app.get("/timetable-versions/{version_id}", response_model=schemas.TimetableVersion)
@@ -395,6 +531,7 @@ def update_timetable_version(version_id: int, version: schemas.TimetableVersionU
     
     db.commit()
     db.refresh(db_version)
+    change_tracker.bump("timetable_versions")
     return db_version
 
 @app.delete("/timetable-versions/{version_id}")
@@ -404,40 +541,258 @@ def delete_timetable_version(version_id: int, db: Session = Depends(get_session)
         raise HTTPException(status_code=404, detail="Timetable version not found")
     db.delete(version)
     db.commit()
+    # Its classes are detached from the version
+    conflict_index.invalidate()
+    version_stats.invalidate([version_id])
+    room_index.invalidate_classes()
+    change_tracker.bump("classes", "timetable_versions")
     return {"message": "Timetable version deleted successfully"}
 
+@app.post("/timetable-versions/{version_id}/clone", response_model=schemas.TimetableVersion)
+def clone_timetable_version(version_id: int, clone: schemas.TimetableVersionClone, db: Session = Depends(get_session)):
+    """Create a new version holding a copy of every class of this one"""
+    version = db.query(models.TimetableVersion).filter(models.TimetableVersion.version_id == version_id).first()
+    if version is None:
+        raise HTTPException(status_code=404, detail="Timetable version not found")
+    
+    db_version = models.TimetableVersion(
+        created_by=clone.created_by,
+        phase=clone.phase or version.phase,
+        description=clone.description if clone.description is not None else f"Copy of version {version_id}",
+    )
+    db.add(db_version)
+    try:
+        db.flush()
+        clone_classes(db, version_id, db_version.version_id)
+        db.commit()
+    except IntegrityError as error:
+        db.rollback()
+        if not is_id_collision(error):
+            raise
+        raise HTTPException(status_code=409, detail="Version changed while cloning, try again")
+    db.refresh(db_version)
+    
+    conflict_index.invalidate()
+    room_index.invalidate_classes()
+    change_tracker.bump("classes", "timetable_versions")
+    return db_version
+
+@app.get("/timetable-versions/{version_id}/conflicts", response_model=schemas.ConflictReport)
+def get_timetable_version_conflicts(version_id: int, db: Session = Depends(get_session)):
+    """Report every room, teacher, class group and unavailability clash in a version"""
+    version = db.query(models.TimetableVersion).filter(models.TimetableVersion.version_id == version_id).first()
+    if version is None:
+        raise HTTPException(status_code=404, detail="Timetable version not found")
+    class_count, conflicts = find_version_conflicts(db, version_id)
+    return {"version_id": version_id, "class_count": class_count, "conflicts": conflicts}
+
+@app.get("/timetable-versions/{version_id}/over-capacity", response_model=schemas.OverCapacityReport)
+def get_timetable_version_over_capacity(version_id: int, db: Session = Depends(get_session)):
+    """List every class of a version whose groups enroll more students than its room seats"""
+    version = db.query(models.TimetableVersion).filter(models.TimetableVersion.version_id == version_id).first()
+    if version is None:
+        raise HTTPException(status_code=404, detail="Timetable version not found")
+    class_count, classes = find_version_overcapacity(db, version_id)
+    return {"version_id": version_id, "class_count": class_count, "classes": classes}
+
+@app.get("/timetable-versions/{version_id}/stats", response_model=schemas.VersionStats)
+def get_timetable_version_stats(version_id: int, db: Session = Depends(get_session)):
+    """Teacher workload, room occupancy and seat utilization of a version"""
+    stats = version_stats.get(db, version_id)
+    if stats is None:
+        raise HTTPException(status_code=404, detail="Timetable version not found")
+    return stats
+
+@app.get("/timetable-versions/{version_id}/export")
+def export_timetable_version(version_id: int, format: str = "ndjson", db: Session = Depends(get_session)):
+    """Stream every class of a version as flat NDJSON or CSV rows"""
+    version = db.query(models.TimetableVersion).filter(models.TimetableVersion.version_id == version_id).first()
+    if version is None:
+        raise HTTPException(status_code=404, detail="Timetable version not found")
+    if format == "ndjson":
+        body, media_type = iter_ndjson(version_id), "application/x-ndjson"
+    elif format == "csv":
+        body, media_type = iter_csv(version_id), "text/csv"
+    else:
+        raise HTTPException(status_code=400, detail="Format must be ndjson or csv")
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="timetable-version-{version_id}.{format}"'},
+    )
+
+def validate_scheduling_options(options: schemas.SchedulingOptions):
+    if not options.days or any(day < 1 or day > 7 for day in options.days):
+        raise HTTPException(status_code=400, detail="Days must be between 1 and 7")
+    if options.day_start >= options.day_end or options.slot_minutes <= 0:
+        raise HTTPException(status_code=400, detail="Invalid scheduling window")
+
+def validate_class_requests(items: List[schemas.ClassRequest], db: Session):
+    """Reject durations off the solver grid and ids that do not exist"""
+    if any(item.duration_minutes <= 0 for item in items):
+        raise HTTPException(status_code=400, detail="Class duration must be positive")
+    if any(item.duration_minutes % UNIT_MINUTES for item in items):
+        raise HTTPException(status_code=400, detail=f"Class duration must be a multiple of {UNIT_MINUTES} minutes")
+    references = (
+        (models.Subject.subject_id, {item.subject_id for item in items}, "Subject not found"),
+        (models.User.user_id, {item.teacher_id for item in items}, "Teacher not found"),
+        (models.ClassGroup.class_group_id, {group_id for item in items for group_id in item.class_group_ids}, "Class group not found"),
+        (models.Room.room_id, {item.room_id for item in items if item.room_id is not None}, "Room not found"),
+    )
+    for column, ids, detail in references:
+        if ids and len(db.scalars(select(column).where(column.in_(ids))).all()) < len(ids):
+            raise HTTPException(status_code=404, detail=detail)
+
+@app.post("/timetable-versions/{version_id}/generate", response_model=schemas.TimetableGenerationResult)
+def generate_timetable(version_id: int, request: schemas.TimetableGenerationRequest, db: Session = Depends(get_session)):
+    """Place unscheduled classes into a version with the timetable solver"""
+    version = db.query(models.TimetableVersion).filter(models.TimetableVersion.version_id == version_id).first()
+    if version is None:
+        raise HTTPException(status_code=404, detail="Timetable version not found")
+    validate_scheduling_options(request)
+    validate_class_requests(request.classes, db)
+    
+    # Class writes to the version wait, so the solver's view of it stays current
+    with conflict_index.write_lock(version_id):
+        problem = build_problem(db, version_id, request)
+        future = get_solver_pool().submit(solve, problem)
+        try:
+            solution = future.result(timeout=SOLVER_TIMEOUT)
+        except FutureTimeoutError:
+            # Still queued behind other runs: nothing was spent on it yet
+            if future.cancel():
+                raise HTTPException(status_code=503, detail="Timetable solver is busy", headers={"Retry-After": "5"})
+            raise HTTPException(status_code=504, detail="Timetable generation timed out")
+        
+        created = build_classes(db, version_id, request, solution)
+        db.add_all(created)
+        db.commit()
+        for db_class in created:
+            conflict_index.add(db_class)
+    version_stats.invalidate([version_id])
+    room_index.invalidate_classes()
+    change_tracker.bump("classes")
+    
+    return {
+        "version_id": version_id,
+        "scheduled": created,
+        "unscheduled": [
+            {"index": index, "reason": reason}
+            for index, reason in sorted(solution.unplaced.items())
+        ],
+    }
+
+@app.post("/timetable-versions/{version_id}/repair", response_model=schemas.TimetableRepairResult)
+def repair_timetable(version_id: int, request: schemas.TimetableRepairRequest, db: Session = Depends(get_session)):
+    """Re-plan only the classes affected by changed rooms, teachers or classes"""
+    version = db.query(models.TimetableVersion).filter(models.TimetableVersion.version_id == version_id).first()
+    if version is None:
+        raise HTTPException(status_code=404, detail="Timetable version not found")
+    validate_scheduling_options(request)
+    
+    # Repairs touch a handful of classes, so they run inline
+    with conflict_index.write_lock(version_id):
+        problem, current, classes = build_repair_problem(db, version_id, request)
+        solution = repair(problem, current)
+        changes = repair_changes(classes, current, solution)
+        
+        if request.apply and changes:
+            db.commit()
+            for change in changes:
+                conflict_index.add(classes[change["class_id"]])
+        else:
+            db.rollback()
+    if request.apply and changes:
+        version_stats.invalidate([version_id])
+        room_index.invalidate_classes()
+        change_tracker.bump("classes")
+    
+    return {
+        "version_id": version_id,
+        "checked": len(classes),
+        "changes": changes,
+        "unresolved": [
+            {"class_id": class_id, "reason": reason}
+            for class_id, reason in sorted(solution.unplaced.items())
+        ],
+    }
+
 # Class endpoints
-@app.post("/classes/", response_model=schemas.Class)
+def check_class_conflicts(db_class: models.Class, db: Session):
+    """Reject a class whose room or teacher is already booked at that time"""
+    conflict_index.ensure_loaded(db)
+    conflicts = conflict_index.find_conflicts(db_class)
+    if conflicts:
+        raise HTTPException(
+            status_code=409,
+            detail=jsonable_encoder({
+                "message": "Room or teacher is already booked at this time",
+                "conflicts": conflicts,
+            }),
+        )
+
+def check_room_capacity(room_id: int, class_group_ids: List[int], db: Session):
+    """Reject a class whose groups enroll more students than its room seats"""
+    excess = capacity_index.snapshot(db).check(room_id, class_group_ids)
+    if excess is not None:
+        enrolled, capacity = excess
+        raise HTTPException(
+            status_code=409,
+            detail={
+                "message": "Class groups do not fit in the room",
+                "room_id": room_id,
+                "enrolled": enrolled,
+                "capacity": capacity,
+            },
+        )
+
+@app.post("/classes/", response_model=schemas.Class, responses={409: {"description": "Scheduling conflict or room over capacity"}})
 def create_class(class_data: schemas.ClassCreate, db: Session = Depends(get_session)):
     class_dict = class_data.model_dump()
     class_group_ids = class_dict.pop('class_group_ids', [])
     
     db_class = models.Class(**class_dict)
-    db.add(db_class)
-    db.commit()
-    
-    # Add class groups
-    if class_group_ids:
-        class_groups = db.query(models.ClassGroup).filter(models.ClassGroup.class_group_id.in_(class_group_ids)).all()
-        db_class.class_groups.extend(class_groups)
+    with conflict_index.write_lock(db_class.version_id):
+        check_class_conflicts(db_class, db)
+        check_room_capacity(db_class.room_id, class_group_ids, db)
+        db.add(db_class)
         db.commit()
-    
-    db.refresh(db_class)
+        
+        # Add class groups
+        if class_group_ids:
+            class_groups = db.query(models.ClassGroup).filter(models.ClassGroup.class_group_id.in_(class_group_ids)).all()
+            db_class.class_groups.extend(class_groups)
+            db.commit()
+        
+        db.refresh(db_class)
+        conflict_index.add(db_class)
+    version_stats.class_saved(db, db_class.class_id)
+    room_index.invalidate_classes()
+    change_tracker.bump("classes")
     return db_class
 
-@app.get("/classes/", response_model=List[schemas.Class])
-def read_classes(skip: int = 0, limit: int = 100, db: Session = Depends(get_session)):
-    classes = db.query(models.Class).offset(skip).limit(limit).all()
+@app.get("/classes/", response_model=list_or_flat(schemas.Class))
+async def read_classes(request: Request, response: Response, skip: int = 0, limit: int = 100, after: Optional[str] = None, view: Optional[View] = None, db: AsyncSession = Depends(get_async_session)):
+    cached = not_modified(request, response, CLASS_TABLES)
+    if cached:
+        return cached
+    statement = select(models.Class).options(*load_options(models.Class, schemas.Class))
+    classes = await paginate_async(db, statement, models.Class.class_id, response, after, skip, limit)
+    if view == "flat":
+        return flat_response(classes, models.Class, schemas.Class, response)
     return classes
 
 @app.get("/classes/{class_id}", response_model=schemas.Class)
-def read_class(class_id: int, db: Session = Depends(get_session)):
-    class_obj = db.query(models.Class).filter(models.Class.class_id == class_id).first()
+async def read_class(class_id: int, db: AsyncSession = Depends(get_async_session)):
+    result = await db.execute(
+        select(models.Class).options(*load_options(models.Class, schemas.Class)).where(models.Class.class_id == class_id)
+    )
+    class_obj = result.scalar_one_or_none()
     if class_obj is None:
         raise HTTPException(status_code=404, detail="Class not found")
     return class_obj
 
-@app.put("/classes/{class_id}", response_model=schemas.Class)
+@app.put("/classes/{class_id}", response_model=schemas.Class, responses={409: {"description": "Scheduling conflict or room over capacity"}})
 def update_class(class_id: int, class_data: schemas.ClassUpdate, db: Session = Depends(get_session)):
     db_class = db.query(models.Class).filter(models.Class.class_id == class_id).first()
     if db_class is None:
@@ -448,16 +803,28 @@ def update_class(class_id: int, class_data: schemas.ClassUpdate, db: Session = D
     
     for field, value in update_data.items():
         setattr(db_class, field, value)
-    
-    # Update class groups if provided
-    if class_group_ids is not None:
-        db_class.class_groups.clear()
-        if class_group_ids:
-            class_groups = db.query(models.ClassGroup).filter(models.ClassGroup.class_group_id.in_(class_group_ids)).all()
-            db_class.class_groups.extend(class_groups)
-    
-    db.commit()
-    db.refresh(db_class)
+    with conflict_index.write_lock(db_class.version_id):
+        check_class_conflicts(db_class, db)
+        if "room_id" in update_data or class_group_ids is not None:
+            if class_group_ids is not None:
+                group_ids = class_group_ids
+            else:
+                group_ids = [group.class_group_id for group in db_class.class_groups]
+            check_room_capacity(db_class.room_id, group_ids, db)
+        
+        # Update class groups if provided
+        if class_group_ids is not None:
+            db_class.class_groups.clear()
+            if class_group_ids:
+                class_groups = db.query(models.ClassGroup).filter(models.ClassGroup.class_group_id.in_(class_group_ids)).all()
+                db_class.class_groups.extend(class_groups)
+        
+        db.commit()
+        db.refresh(db_class)
+        conflict_index.add(db_class)
+    version_stats.class_saved(db, db_class.class_id)
+    room_index.invalidate_classes()
+    change_tracker.bump("classes")
     return db_class
 
 @app.delete("/classes/{class_id}")
@@ -467,8 +834,35 @@ def delete_class(class_id: int, db: Session = Depends(get_session)):
         raise HTTPException(status_code=404, detail="Class not found")
     db.delete(class_obj)
     db.commit()
+    conflict_index.remove(class_id)
+    version_stats.class_deleted(class_id)
+    room_index.invalidate_classes()
+    change_tracker.bump("classes")
     return {"message": "Class deleted successfully"}
 
+@app.get("/occurrences", response_model=List[schemas.Occurrence])
+def read_occurrences(
+    start: date,
+    end: date,
+    version_id: Optional[int] = None,
+    teacher_id: Optional[int] = None,
+    room_id: Optional[int] = None,
+    class_group_id: Optional[int] = None,
+    db: Session = Depends(get_session),
+):
+    """
+    Get the dated occurrences of classes from start to end (inclusive), skipping holidays and breaks.
+    Classes of the current version unless version_id is given.
+    """
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+    if (end - start).days > MAX_OCCURRENCE_DAYS:
+        raise HTTPException(status_code=400, detail=f"Date range is limited to {MAX_OCCURRENCE_DAYS} days")
+    if version_id is None:
+        version_id = current_version_id(db)
+    occurrences = occurrence_engine.between(db, start, end, version_id, teacher_id, room_id, class_group_id)
+    return [occurrence._asdict() for occurrence in occurrences]
+
 # Unavailability endpoints
 @app.post("/unavailabilities/", response_model=schemas.Unavailability)
 def create_unavailability(unavailability: schemas.UnavailabilityCreate, db: Session = Depends(get_session)):
@@ -479,9 +873,9 @@ def create_unavailability(unavailability: schemas.UnavailabilityCreate, db: Sess
     return db_unavailability
 
 @app.get("/unavailabilities/", response_model=List[schemas.Unavailability])
-def read_unavailabilities(skip: int = 0, limit: int = 100, db: Session = Depends(get_session)):
-    unavailabilities = db.query(models.Unavailability).offset(skip).limit(limit).all()
-    return unavailabilities
+def read_unavailabilities(response: Response, skip: int = 0, limit: int = 100, after: Optional[str] = None, db: Session = Depends(get_session)):
+    query = db.query(models.Unavailability).options(*load_options(models.Unavailability, schemas.Unavailability))
+    return paginate(query, models.Unavailability.unavailability_id, response, after, skip, limit)
 
 @app.get("/unavailabilities/{unavailability_id}", response_model=schemas.Unavailability)
 def read_unavailability(unavailability_id: int, db: Session = Depends(get_session)):
@@ -520,12 +914,13 @@ def create_calendar_event(event: schemas.CalendarEventCreate, db: Session = Depe
     db.add(db_event)
     db.commit()
     db.refresh(db_event)
+    change_tracker.bump("calendar_events")
     return db_event
 
 @app.get("/calendar-events/", response_model=List[schemas.CalendarEvent])
-def read_calendar_events(skip: int = 0, limit: int = 100, db: Session = Depends(get_session)):
-    events = db.query(models.CalendarEvent).offset(skip).limit(limit).all()
-    return events
+def read_calendar_events(response: Response, skip: int = 0, limit: int = 100, after: Optional[str] = None, db: Session = Depends(get_session)):
+    query = db.query(models.CalendarEvent).options(*load_options(models.CalendarEvent, schemas.CalendarEvent))
+    return paginate(query, models.CalendarEvent.event_id, response, after, skip, limit)
 
 @app.get("/calendar-events/{event_id}", response_model=schemas.CalendarEvent)
 def read_calendar_event(event_id: int, db: Session = Depends(get_session)):
@@ -546,6 +941,7 @@ def update_calendar_event(event_id: int, event: schemas.CalendarEventUpdate, db:
     
     db.commit()
     db.refresh(db_event)
+    change_tracker.bump("calendar_events")
     return db_event
 
 @app.delete("/calendar-events/{event_id}")
@@ -555,6 +951,7 @@ def delete_calendar_event(event_id: int, db: Session = Depends(get_session)):
         raise HTTPException(status_code=404, detail="Calendar event not found")
     db.delete(event)
     db.commit()
+    change_tracker.bump("calendar_events")
     return {"message": "Calendar event deleted successfully"}
 
 # Approval endpoints
@@ -567,8 +964,15 @@ def create_approval(approval: schemas.ApprovalCreate, db: Session = Depends(get_
     return db_approval
 
 @app.get("/approvals/", response_model=List[schemas.Approval])
-def read_approvals(skip: int = 0, limit: int = 100, db: Session = Depends(get_session)):
-    approvals = db.query(models.Approval).offset(skip).limit(limit).all()
+def read_approvals(response: Response, skip: int = 0, limit: int = 100, after: Optional[str] = None, db: Session = Depends(get_session)):
+    query = db.query(models.Approval).options(*load_options(models.Approval, schemas.Approval))
+    return paginate(query, models.Approval.approval_id, response, after, skip, limit)
+
+# Registered before /approvals/{approval_id}, which would otherwise match it
+@app.get("/approvals/pending", response_model=List[schemas.Approval])
+def get_pending_approvals(db: Session = Depends(get_session)):
+    """Get all pending approvals"""
+    approvals = db.query(models.Approval).options(*load_options(models.Approval, schemas.Approval)).filter(models.Approval.status == schemas.ApprovalStatus.pending).all()
     return approvals
 
 @app.get("/approvals/{approval_id}", response_model=schemas.Approval)
@@ -594,8 +998,8 @@ def respond_to_approval(approval_id: int, response: schemas.ApprovalResponse, db
         db_approval.notes = response.notes
     
     db.commit()
-    db.refresh(db_approval)
-    return db_approval
+    # One statement for the approval and everything it serializes
+    return db.query(models.Approval).options(*load_options(models.Approval, schemas.Approval)).filter(models.Approval.approval_id == approval_id).one()
 
 @app.delete("/approvals/{approval_id}")
 def delete_approval(approval_id: int, db: Session = Depends(get_session)):
@@ -607,32 +1011,74 @@ def delete_approval(approval_id: int, db: Session = Depends(get_session)):
     return {"message": "Approval deleted successfully"}
 
 # Additional utility endpoints
-@app.get("/users/{user_id}/classes", response_model=List[schemas.Class])
-def get_user_classes(user_id: int, db: Session = Depends(get_session)):
+@app.get("/users/{user_id}/classes", response_model=list_or_flat(schemas.Class))
+async def get_user_classes(user_id: int, view: Optional[View] = None, db: AsyncSession = Depends(get_async_session)):
     """Get all classes taught by a specific user"""
-    classes = db.query(models.Class).filter(models.Class.teacher_id == user_id).all()
+    result = await db.execute(
+        select(models.Class).options(*load_options(models.Class, schemas.Class)).where(models.Class.teacher_id == user_id)
+    )
+    classes = result.scalars().all()
+    if view == "flat":
+        return flat_response(classes, models.Class, schemas.Class)
     return classes
 
-@app.get("/rooms/{room_id}/classes", response_model=List[schemas.Class])
-def get_room_classes(room_id: int, db: Session = Depends(get_session)):
+@app.get("/rooms/{room_id}/classes", response_model=list_or_flat(schemas.Class))
+async def get_room_classes(room_id: int, view: Optional[View] = None, db: AsyncSession = Depends(get_async_session)):
     """Get all classes scheduled in a specific room"""
-    classes = db.query(models.Class).filter(models.Class.room_id == room_id).all()
+    result = await db.execute(
+        select(models.Class).options(*load_options(models.Class, schemas.Class)).where(models.Class.room_id == room_id)
+    )
+    classes = result.scalars().all()
+    if view == "flat":
+        return flat_response(classes, models.Class, schemas.Class)
     return classes
 
-@app.get("/subjects/{subject_id}/classes", response_model=List[schemas.Class])
-def get_subject_classes(subject_id: int, db: Session = Depends(get_session)):
+@app.get("/subjects/{subject_id}/classes", response_model=list_or_flat(schemas.Class))
+async def get_subject_classes(subject_id: int, view: Optional[View] = None, db: AsyncSession = Depends(get_async_session)):
     """Get all classes for a specific subject"""
-    classes = db.query(models.Class).filter(models.Class.subject_id == subject_id).all()
+    result = await db.execute(
+        select(models.Class).options(*load_options(models.Class, schemas.Class)).where(models.Class.subject_id == subject_id)
+    )
+    classes = result.scalars().all()
+    if view == "flat":
+        return flat_response(classes, models.Class, schemas.Class)
     return classes
 
+def calendar_feed(request: Request, kind: str, resource_id: int, version_id: Optional[int], start: Optional[date], end: Optional[date], db: Session):
+    response = Response(media_type="text/calendar; charset=utf-8")
+    cached = not_modified(request, response, FEED_TABLES)
+    if cached:
+        return cached
+    default_start, default_end = academic_year(date.today())
+    start, end = start or default_start, end or default_end
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+    if version_id is None:
+        version_id = current_version_id(db)
+    feed = feed_cache.get(db, kind, resource_id, version_id, start, end)
+    if feed is None:
+        raise HTTPException(status_code=404, detail=f"{kind.replace('_', ' ').capitalize()} not found")
+    response.body = feed
+    response.headers["Content-Length"] = str(len(feed))
+    return response
+
+@app.get("/users/{user_id}/timetable.ics", response_class=Response)
+def get_user_calendar(request: Request, user_id: int, version_id: Optional[int] = None, start: Optional[date] = None, end: Optional[date] = None, db: Session = Depends(get_session)):
+    """iCalendar feed of the classes taught by a user (current version and academic year by default)"""
+    return calendar_feed(request, "user", user_id, version_id, start, end, db)
+
+@app.get("/rooms/{room_id}/timetable.ics", response_class=Response)
+def get_room_calendar(request: Request, room_id: int, version_id: Optional[int] = None, start: Optional[date] = None, end: Optional[date] = None, db: Session = Depends(get_session)):
+    """iCalendar feed of the classes in a room (current version and academic year by default)"""
+    return calendar_feed(request, "room", room_id, version_id, start, end, db)
+
+@app.get("/class-groups/{class_group_id}/timetable.ics", response_class=Response)
+def get_class_group_calendar(request: Request, class_group_id: int, version_id: Optional[int] = None, start: Optional[date] = None, end: Optional[date] = None, db: Session = Depends(get_session)):
+    """iCalendar feed of the classes of a class group (current version and academic year by default)"""
+    return calendar_feed(request, "class_group", class_group_id, version_id, start, end, db)
+
 @app.get("/users/{user_id}/unavailabilities", response_model=List[schemas.Unavailability])
 def get_user_unavailabilities(user_id: int, db: Session = Depends(get_session)):
     """Get all unavailabilities for a specific user"""
-    unavailabilities = db.query(models.Unavailability).filter(models.Unavailability.teacher_id == user_id).all()
+    unavailabilities = db.query(models.Unavailability).options(*load_options(models.Unavailability, schemas.Unavailability)).filter(models.Unavailability.teacher_id == user_id).all()
     return unavailabilities
-
-@app.get("/approvals/pending", response_model=List[schemas.Approval])
-def get_pending_approvals(db: Session = Depends(get_session)):
-    """Get all pending approvals"""
-    approvals = db.query(models.Approval).filter(models.Approval.status == schemas.ApprovalStatus.pending).all()
-    return approvals
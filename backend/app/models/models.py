@@ -17,6 +17,7 @@ from sqlalchemy import (
     UniqueConstraint,
     Text,
     Table,
+    JSON,
 )
 from sqlalchemy.orm import mapped_column, relationship
 from sqlalchemy import Enum as SQLEnum
@@ -311,6 +312,24 @@ class CalendarEvent(Base):
     )
 
 
+class TimetableEvent(Base):
+    """Free-form entries of the /timetable/events calendar feed"""
+
+    __tablename__ = "timetable_events"
+
+    event_id = mapped_column(Integer, primary_key=True)
+    title = mapped_column(String(200), nullable=False)
+    start_at = mapped_column(DateTime, nullable=False)
+    end_at = mapped_column(DateTime, nullable=False)
+    background_color = mapped_column(String(30))
+    extended_props = mapped_column(JSON)
+
+    __table_args__ = (
+        CheckConstraint("start_at <= end_at", name="chk_timetable_event_order"),
+        Index("idx_timetable_event_range", "start_at", "end_at"),
+    )
+
+
 class Approval(Base):
     __tablename__ = "approvals"
 
@@ -0,0 +1,328 @@
+"""
+Shared occupancy model for rooms, teachers and class groups.
+
+Every resource gets one fixed-width bitset per week at 15 minute resolution
+(7 days x 96 slots, packed into eleven unsigned 64-bit words). Recurring
+classes and unavailabilities go into the resource's weekly template; dated
+ones go into the bitset of their ISO week. Asking whether a resource is free
+between two times is then a couple of word ANDs.
+"""
+from array import array
+from bisect import bisect_left
+from datetime import date, time
+from threading import Lock
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from sqlalchemy.orm import Session
+
+from app.cache import reference_cache
+from app.etags import change_tracker
+from app.loading import load_options
+from app.models import models
+from app.schemas import classes as schemas
+
+SLOT_MINUTES = 15
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+SLOTS_PER_WEEK = 7 * SLOTS_PER_DAY
+WORDS_PER_WEEK = -(-SLOTS_PER_WEEK // 64)
+
+ROOM = "room"
+TEACHER = "teacher"
+GROUP = "group"
+
+# (kind, resource_id)
+Resource = Tuple[str, int]
+# (ISO year, ISO week)
+Week = Tuple[int, int]
+
+TimeLike = Union[time, int]
+
+
+def _minutes(value: TimeLike) -> int:
+    if isinstance(value, int):
+        return value
+    return value.hour * 60 + value.minute
+
+
+def slot_range(day_of_week: int, start: TimeLike, end: TimeLike) -> Tuple[int, int]:
+    """Week slots [first, last) covering start-end on a weekday (1 = Monday)"""
+    base = (day_of_week - 1) * SLOTS_PER_DAY
+    first = _minutes(start) // SLOT_MINUTES
+    last = -(-_minutes(end) // SLOT_MINUTES)
+    return base + first, base + max(last, first + 1)
+
+
+def word_masks(first: int, last: int) -> Iterator[Tuple[int, int]]:
+    """(word index, bit mask) pairs covering slots [first, last)"""
+    for word in range(first >> 6, ((last - 1) >> 6) + 1):
+        low = max(first, word << 6) - (word << 6)
+        high = min(last, (word + 1) << 6) - (word << 6)
+        yield word, ((1 << (high - low)) - 1) << low
+
+
+def new_bitset() -> array:
+    return array("Q", bytes(8 * WORDS_PER_WEEK))
+
+
+class OccupancyGrid:
+    """Weekly occupancy bitsets for any number of resources"""
+
+    def __init__(self):
+        self._weekly: Dict[Resource, array] = {}
+        self._dated: Dict[Resource, Dict[Week, array]] = {}
+
+    def __len__(self):
+        return len(self._weekly.keys() | self._dated.keys())
+
+    def memory_bytes(self) -> int:
+        """Size of the bitset payload"""
+        count = len(self._weekly) + sum(len(weeks) for weeks in self._dated.values())
+        return count * WORDS_PER_WEEK * 8
+
+    def _bitset(self, resource: Resource, on_date: Optional[date]) -> array:
+        if on_date is None:
+            bitset = self._weekly.get(resource)
+            if bitset is None:
+                bitset = self._weekly[resource] = new_bitset()
+            return bitset
+        weeks = self._dated.setdefault(resource, {})
+        week = on_date.isocalendar()[:2]
+        bitset = weeks.get(week)
+        if bitset is None:
+            bitset = weeks[week] = new_bitset()
+        return bitset
+
+    def mark(
+        self,
+        kind: str,
+        resource_id: int,
+        start: TimeLike,
+        end: TimeLike,
+        day_of_week: Optional[int] = None,
+        on_date: Optional[date] = None,
+    ):
+        """Mark a resource busy, either every week on day_of_week or on one date"""
+        weekday = on_date.isoweekday() if on_date is not None else day_of_week
+        if weekday is None:
+            return
+        bitset = self._bitset((kind, resource_id), on_date)
+        for word, mask in word_masks(*slot_range(weekday, start, end)):
+            bitset[word] |= mask
+
+    def _bitsets(self, resource: Resource, on_date: Optional[date]) -> Iterable[array]:
+        """Bitsets a query touches: the template plus one dated week, or all of them"""
+        weekly = self._weekly.get(resource)
+        if weekly is not None:
+            yield weekly
+        weeks = self._dated.get(resource, {})
+        if on_date is None:
+            yield from weeks.values()
+        else:
+            dated = weeks.get(on_date.isocalendar()[:2])
+            if dated is not None:
+                yield dated
+
+    def is_free(
+        self,
+        kind: str,
+        resource_id: int,
+        start: TimeLike,
+        end: TimeLike,
+        day_of_week: Optional[int] = None,
+        on_date: Optional[date] = None,
+    ) -> bool:
+        """
+        Whether a resource is free between start and end on a date, or on a
+        weekday in every week (which also checks all dated bookings)
+        """
+        weekday = on_date.isoweekday() if on_date is not None else day_of_week
+        masks = list(word_masks(*slot_range(weekday, start, end)))
+        for bitset in self._bitsets((kind, resource_id), on_date):
+            for word, mask in masks:
+                if bitset[word] & mask:
+                    return False
+        return True
+
+    def day_mask(
+        self, kind: str, resource_id: int, day_of_week: int, on_date: Optional[date] = None, dated: bool = True
+    ) -> int:
+        """
+        Busy slots of a weekday as an int, bit i being slot i of the day.
+        With dated=False only the weekly template counts.
+        """
+        first = (day_of_week - 1) * SLOTS_PER_DAY
+        combined = 0
+        if dated:
+            bitsets = list(self._bitsets((kind, resource_id), on_date))
+        else:
+            weekly = self._weekly.get((kind, resource_id))
+            bitsets = [weekly] if weekly is not None else []
+        for bitset in bitsets:
+            for word, _ in word_masks(first, first + SLOTS_PER_DAY):
+                combined |= bitset[word] << (word << 6)
+        return (combined >> first) & ((1 << SLOTS_PER_DAY) - 1)
+
+    def resources(self, kind: str) -> Iterator[int]:
+        for resource_kind, resource_id in self._weekly.keys() | self._dated.keys():
+            if resource_kind == kind:
+                yield resource_id
+
+    @classmethod
+    def from_db(
+        cls,
+        db: Session,
+        version_id: Optional[int] = None,
+        exclude_class_ids: Iterable[int] = (),
+        unavailabilities: bool = True,
+    ) -> "OccupancyGrid":
+        """
+        Build the occupancy of a timetable version: its classes for rooms,
+        teachers and class groups, plus every teacher unavailability.
+        Uses one query each for classes, group assignments and unavailabilities.
+        """
+        grid = cls()
+        excluded = set(exclude_class_ids)
+        classes = (
+            db.query(
+                models.Class.class_id,
+                models.Class.room_id,
+                models.Class.teacher_id,
+                models.Class.day_of_week,
+                models.Class.date,
+                models.Class.start_time,
+                models.Class.end_time,
+            )
+            .filter(
+                models.Class.version_id == version_id,
+                models.Class.approval_status != models.ApprovalStatus.rejected,
+            )
+            .all()
+        )
+        spans = {}
+        for class_id, room_id, teacher_id, day, on_date, start, end in classes:
+            if class_id in excluded:
+                continue
+            spans[class_id] = (start, end, day, on_date)
+            grid.mark(ROOM, room_id, start, end, day, on_date)
+            grid.mark(TEACHER, teacher_id, start, end, day, on_date)
+
+        if spans:
+            assignments = (
+                db.query(
+                    models.class_group_assignments.c.class_id,
+                    models.class_group_assignments.c.class_group_id,
+                )
+                .join(models.Class, models.Class.class_id == models.class_group_assignments.c.class_id)
+                .filter(models.Class.version_id == version_id)
+                .all()
+            )
+            for class_id, class_group_id in assignments:
+                if class_id in spans:
+                    grid.mark(GROUP, class_group_id, *spans[class_id])
+
+        if unavailabilities:
+            for teacher_id, day, on_date, start, end, is_full_day in db.query(
+                models.Unavailability.teacher_id,
+                models.Unavailability.day_of_week,
+                models.Unavailability.date,
+                models.Unavailability.start_time,
+                models.Unavailability.end_time,
+                models.Unavailability.is_full_day,
+            ).all():
+                if is_full_day or start is None or end is None:
+                    start, end = 0, 24 * 60
+                grid.mark(TEACHER, teacher_id, start, end, day, on_date)
+
+        return grid
+
+
+class FreeRoomIndex:
+    """
+    Answers "which rooms are free" without touching the database: rooms are
+    kept sorted by capacity per location next to a room occupancy grid per
+    timetable version. Room writes and class writes drop the stale parts,
+    which are rebuilt on the next query.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # location_id -> (capacities, rooms), both sorted by capacity
+        self._by_location: Optional[Dict[int, Tuple[List[int], list]]] = None
+        self._grids: Dict[Optional[int], OccupancyGrid] = {}
+        self._room_generation = 0
+        self._class_generation = 0
+
+    def invalidate_rooms(self):
+        with self._lock:
+            self._room_generation += 1
+            self._by_location = None
+
+    def invalidate_classes(self):
+        with self._lock:
+            self._class_generation += 1
+            self._grids = {}
+
+    def _load_rooms(self, db: Session):
+        rooms = (
+            db.query(models.Room)
+            .options(*load_options(models.Room, schemas.Room))
+            .order_by(models.Room.capacity, models.Room.room_id)
+            .all()
+        )
+        by_location: Dict[int, Tuple[List[int], list]] = {}
+        for room in rooms:
+            capacities, entries = by_location.setdefault(room.location_id, ([], []))
+            capacities.append(room.capacity)
+            entries.append(schemas.Room.model_validate(room))
+        return by_location
+
+    def _snapshot(self, db: Session, version_id: Optional[int]):
+        with self._lock:
+            by_location = self._by_location
+            grid = self._grids.get(version_id)
+            room_generation, class_generation = self._room_generation, self._class_generation
+        # What was built is used either way, but only published if nothing changed while loading
+        if by_location is None:
+            by_location = self._load_rooms(db)
+            with self._lock:
+                if self._room_generation == room_generation:
+                    self._by_location = by_location
+        if grid is None:
+            grid = OccupancyGrid.from_db(db, version_id, unavailabilities=False)
+            with self._lock:
+                if self._class_generation == class_generation:
+                    self._grids[version_id] = grid
+        return by_location, grid
+
+    def find(
+        self,
+        db: Session,
+        start: TimeLike,
+        end: TimeLike,
+        day_of_week: Optional[int] = None,
+        on_date: Optional[date] = None,
+        location_id: Optional[int] = None,
+        min_capacity: int = 0,
+        version_id: Optional[int] = None,
+    ) -> list:
+        """Free rooms with at least min_capacity seats, smallest first"""
+        by_location, grid = self._snapshot(db, version_id)
+        locations = [location_id] if location_id is not None else list(by_location)
+        free = []
+        for location in locations:
+            capacities, rooms = by_location.get(location, ([], []))
+            for room in rooms[bisect_left(capacities, min_capacity):]:
+                if grid.is_free(ROOM, room.room_id, start, end, day_of_week, on_date):
+                    free.append(room)
+        if location_id is None:
+            free.sort(key=lambda room: (room.capacity, room.room_id))
+        return free
+
+
+room_index = FreeRoomIndex()
+# Rooms embed their location and owner course, so this follows the
+# reference cache (including invalidations from other workers)
+reference_cache.on_invalidate("rooms", room_index.invalidate_rooms)
+# Class writes in this worker drop the grids themselves
+change_tracker.on_remote_change("classes", room_index.invalidate_classes)
+change_tracker.on_remote_change("timetable_versions", room_index.invalidate_classes)
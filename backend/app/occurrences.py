@@ -0,0 +1,188 @@
+"""
+Expansion of recurring classes into dated occurrences.
+
+A recurring class (day_of_week) takes place on that weekday of every week,
+except on days covered by a holiday or break CalendarEvent; a one-off class
+(date) takes place on its date as scheduled. Occurrences are produced week
+by week from an in-memory snapshot of the classes and the closed days, and
+each materialized week is cached, so rendering a semester costs two queries
+once and dictionary lookups afterwards. Class and calendar event writes
+drop the snapshot and the cached weeks.
+"""
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import date, timedelta
+from threading import Lock
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from app.cache import MISSING, TTLCache
+from app.etags import change_tracker
+from app.models import models
+from app.schemas import classes as schemas
+
+# Calendar events that cancel recurring classes
+CLOSED_EVENT_TYPES = (schemas.EventType.holiday, schemas.EventType.break_)
+CACHED_WEEKS = 256
+MAX_OCCURRENCE_DAYS = 366
+
+
+class Occurrence(NamedTuple):
+    class_id: int
+    date: date
+    start_time: object
+    end_time: object
+    subject_id: int
+    class_type: object
+    teacher_id: int
+    room_id: int
+    class_group_ids: Tuple[int, ...]
+    version_id: Optional[int]
+    is_recurring: bool
+
+
+class DateRangeIndex:
+    """Sorted, merged [start, end] date ranges answering "is this day covered?" by bisection"""
+
+    def __init__(self, ranges: Iterable[Tuple[date, date]]):
+        merged: List[List[date]] = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + timedelta(days=1):
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self._starts = [start for start, _ in merged]
+        self._ends = [end for _, end in merged]
+
+    def covers(self, day: date) -> bool:
+        i = bisect_right(self._starts, day) - 1
+        return i >= 0 and day <= self._ends[i]
+
+    def __len__(self):
+        return len(self._starts)
+
+
+def closed_days(db: Session) -> DateRangeIndex:
+    """Days on which recurring classes do not take place"""
+    return DateRangeIndex(
+        db.execute(
+            select(models.CalendarEvent.start_date, models.CalendarEvent.end_date).where(
+                models.CalendarEvent.type.in_(CLOSED_EVENT_TYPES)
+            )
+        ).all()
+    )
+
+
+class _Snapshot:
+    """Classes by weekday (recurring) and by date (one-off), and the closed days"""
+
+    def __init__(self, db: Session):
+        assignments = models.class_group_assignments
+        groups: Dict[int, List[int]] = defaultdict(list)
+        for class_id, class_group_id in db.execute(
+            select(assignments.c.class_id, assignments.c.class_group_id)
+        ):
+            groups[class_id].append(class_group_id)
+
+        self.recurring: Dict[Tuple[Optional[int], int], List[tuple]] = defaultdict(list)
+        self.dated: Dict[Tuple[Optional[int], date], List[tuple]] = defaultdict(list)
+        rows = db.execute(
+            select(
+                models.Class.class_id,
+                models.Class.start_time,
+                models.Class.end_time,
+                models.Class.subject_id,
+                models.Class.class_type,
+                models.Class.teacher_id,
+                models.Class.room_id,
+                models.Class.version_id,
+                models.Class.day_of_week,
+                models.Class.date,
+            )
+            .where(models.Class.approval_status != schemas.ApprovalStatus.rejected)
+        )
+        for class_id, start, end, subject_id, class_type, teacher_id, room_id, version_id, weekday, on_date in rows:
+            fields = (class_id, start, end, subject_id, class_type, teacher_id, room_id,
+                      tuple(sorted(groups.get(class_id, ()))), version_id)
+            # Indexed under the version and under None (all versions)
+            for key in {version_id, None}:
+                if on_date is not None:
+                    self.dated[(key, on_date)].append(fields)
+                else:
+                    self.recurring[(key, weekday)].append(fields)
+
+        self.closed = closed_days(db)
+
+    def week(self, version_id: Optional[int], monday: date) -> Tuple[Occurrence, ...]:
+        occurrences = []
+        for offset in range(7):
+            day = monday + timedelta(days=offset)
+            today = []
+            if not self.closed.covers(day):
+                for class_id, start, end, *rest in self.recurring.get((version_id, day.isoweekday()), ()):
+                    today.append(Occurrence(class_id, day, start, end, *rest, True))
+            for class_id, start, end, *rest in self.dated.get((version_id, day), ()):
+                today.append(Occurrence(class_id, day, start, end, *rest, False))
+            today.sort(key=lambda occurrence: (occurrence.start_time, occurrence.class_id))
+            occurrences.extend(today)
+        return tuple(occurrences)
+
+
+class OccurrenceEngine:
+    def __init__(self):
+        self._snapshot: Optional[_Snapshot] = None
+        self._weeks = TTLCache(CACHED_WEEKS, float("inf"))
+        self._lock = Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+            self._weeks.clear()
+
+    def week(self, db: Session, version_id: Optional[int], monday: date) -> Tuple[Occurrence, ...]:
+        """All occurrences of the week starting on monday, materialized once"""
+        key = (version_id, monday)
+        occurrences = self._weeks.get(key)
+        if occurrences is MISSING:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = _Snapshot(db)
+                snapshot = self._snapshot
+            occurrences = snapshot.week(version_id, monday)
+            with self._lock:
+                # Not stored if invalidated while materializing
+                if self._snapshot is snapshot:
+                    self._weeks.set(key, occurrences)
+        return occurrences
+
+    def between(
+        self,
+        db: Session,
+        start: date,
+        end: date,
+        version_id: Optional[int] = None,
+        teacher_id: Optional[int] = None,
+        room_id: Optional[int] = None,
+        class_group_id: Optional[int] = None,
+    ) -> Iterator[Occurrence]:
+        """Occurrences from start to end (inclusive), in date and start time order"""
+        monday = start - timedelta(days=start.weekday())
+        while monday <= end:
+            for occurrence in self.week(db, version_id, monday):
+                if not start <= occurrence.date <= end:
+                    continue
+                if teacher_id is not None and occurrence.teacher_id != teacher_id:
+                    continue
+                if room_id is not None and occurrence.room_id != room_id:
+                    continue
+                if class_group_id is not None and class_group_id not in occurrence.class_group_ids:
+                    continue
+                yield occurrence
+            monday += timedelta(days=7)
+
+
+occurrence_engine = OccurrenceEngine()
+change_tracker.on_change("classes", occurrence_engine.invalidate)
+change_tracker.on_change("calendar_events", occurrence_engine.invalidate)
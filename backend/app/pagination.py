@@ -0,0 +1,79 @@
+"""
+Keyset (cursor) pagination for list endpoints.
+
+Pages are addressed by an opaque cursor holding the last primary key seen,
+so a deep page is a `WHERE key > :last ORDER BY key LIMIT :n` index range
+scan that costs the same as the first page and stays stable under concurrent
+inserts. The cursor for the next page is returned in the X-Next-Cursor
+header, which keeps response bodies unchanged for existing clients.
+"""
+import base64
+import json
+from typing import Optional
+
+from fastapi import HTTPException, Response
+from sqlalchemy import Select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Query
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(key) -> str:
+    payload = json.dumps({"k": key}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded))["k"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid pagination cursor")
+
+
+def _page(statement, key, after: Optional[str], skip: int, limit: int):
+    statement = statement.order_by(key)
+    if after is not None:
+        statement = statement.filter(key > decode_cursor(after))
+    elif skip:
+        statement = statement.offset(skip)
+    return statement.limit(limit)
+
+
+def _set_next_cursor(response: Response, items, key, limit: int):
+    if limit and len(items) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(getattr(items[-1], key.key))
+
+
+def paginate(
+    query: Query,
+    key,
+    response: Response,
+    after: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 100,
+):
+    """
+    Return one page of query ordered by key (a primary key column).
+    Offset paging through skip is still accepted when no cursor is given.
+    """
+    items = _page(query, key, after, skip, limit).all()
+    _set_next_cursor(response, items, key, limit)
+    return items
+
+
+async def paginate_async(
+    db: AsyncSession,
+    statement: Select,
+    key,
+    response: Response,
+    after: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 100,
+):
+    """paginate for a select() statement on an AsyncSession"""
+    result = await db.execute(_page(statement, key, after, skip, limit))
+    items = result.scalars().all()
+    _set_next_cursor(response, items, key, limit)
+    return items
@@ -0,0 +1,149 @@
+"""
+Password hashing off the request threads.
+
+bcrypt costs ~250 ms of CPU per hash or verify at the default cost, so a
+login burst would pin every threadpool thread. Hashes are computed in a
+small process pool instead, awaited from the event loop by the async auth
+endpoints (hash_password_async, verify_password_async) so waiting for
+bcrypt holds no thread at all. At most PASSWORD_QUEUE_LIMIT operations are
+admitted at a time; anything beyond that is answered with 503 right away
+so hash-heavy traffic cannot starve the rest of the API.
+
+The synchronous hash_password and verify_password are for sync endpoints
+and scripts; they count against the same limit.
+
+BCRYPT_ROUNDS sets the cost. Hashes made with another cost still verify
+and are replaced on the next successful login.
+"""
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+from time import perf_counter
+from typing import Optional, Tuple
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from app.metrics import Counter, Gauge, Histogram
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", "2"))
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", str(PASSWORD_WORKERS * 4)))
+
+# min/max rounds make needs_update() flag hashes made with any other cost
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+PASSWORD_SECONDS = Histogram(
+    "password_hash_seconds", "Time spent in the password pool, queueing included", ["operation"]
+)
+PASSWORD_REJECTED = Counter(
+    "password_hash_rejected_total", "Password operations refused because the queue was full", ["operation"]
+)
+PASSWORD_REHASHED = Counter("password_rehashed_total", "Hashes upgraded to BCRYPT_ROUNDS on login")
+
+# Admission for both the sync and the async helpers
+_in_flight = 0
+_in_flight_lock = Lock()
+Gauge(
+    "password_hash_in_flight",
+    "Password operations queued or running in the pool",
+    collect=lambda: {(): _in_flight},
+)
+Gauge("password_hash_queue_limit", "PASSWORD_QUEUE_LIMIT", collect=lambda: {(): PASSWORD_QUEUE_LIMIT})
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_password_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=PASSWORD_WORKERS)
+    return _pool
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, password_hash)
+
+
+def _reject(operation: str):
+    PASSWORD_REJECTED.inc(operation=operation)
+    raise HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many password operations in progress, try again shortly",
+        headers={"Retry-After": "1"},
+    )
+
+
+def _admit(operation: str):
+    """Take a slot, or reject with 503 when PASSWORD_QUEUE_LIMIT are in flight"""
+    global _in_flight
+    with _in_flight_lock:
+        admitted = _in_flight < PASSWORD_QUEUE_LIMIT
+        if admitted:
+            _in_flight += 1
+    if not admitted:
+        _reject(operation)
+
+
+def _release():
+    global _in_flight
+    with _in_flight_lock:
+        _in_flight -= 1
+
+
+def _run(operation: str, function, *args):
+    start = perf_counter()
+    _admit(operation)
+    try:
+        return get_password_pool().submit(function, *args).result()
+    finally:
+        _release()
+        PASSWORD_SECONDS.observe(perf_counter() - start, operation=operation)
+
+
+async def _run_async(operation: str, function, *args):
+    start = perf_counter()
+    _admit(operation)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(get_password_pool(), function, *args)
+    finally:
+        _release()
+        PASSWORD_SECONDS.observe(perf_counter() - start, operation=operation)
+
+
+def _rehashed(result: Tuple[bool, Optional[str]]) -> Tuple[bool, Optional[str]]:
+    if result[1] is not None:
+        PASSWORD_REHASHED.inc()
+    return result
+
+
+def hash_password(password: str) -> str:
+    return _run("hash", _hash, password)
+
+
+def verify_password(password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+    """
+    Check password against password_hash. Returns (valid, new_hash) where
+    new_hash is set when the stored hash should be replaced.
+    """
+    return _rehashed(_run("verify", _verify_and_update, password, password_hash))
+
+
+async def hash_password_async(password: str) -> str:
+    return await _run_async("hash", _hash, password)
+
+
+async def verify_password_async(password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+    """verify_password without holding a thread while bcrypt runs"""
+    return _rehashed(await _run_async("verify", _verify_and_update, password, password_hash))
@@ -1,31 +1,103 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from passlib.context import CryptContext
-from datetime import datetime, timedelta
-from typing import Optional
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from time import monotonic
+from typing import Dict, Optional
 import jwt
+import os
 
+from app import passwords
+from app.cache import MISSING, TTLCache, invalidation_backend, reference_cache
 from app.models.models import User
-from app.database import get_session  # Adjust import path as needed
+from app.database import get_async_session, get_session  # Adjust import path as needed
+from app.instrumentation import InstrumentedRoute
+from app.loading import load_options
 from app.schemas.classes import UserLogin, TokenResponse, UserCreate, User as UserSchema  # Adjust import path as needed
 
-router = APIRouter(prefix="/auth", tags=["auth"])
+router = APIRouter(prefix="/auth", tags=["auth"], route_class=InstrumentedRoute)
 
 # JWT Configuration
 SECRET_KEY = "your-secret-key-change-in-production"  # Change this in production!
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
+# Verified tokens are remembered briefly so authorizing a request needs no query
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "60"))
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
+
+
+class PrincipalCache:
+    """
+    Verified token -> user, keyed by the whole token so a hit implies the
+    signature was checked. Entries end at the token's expiry at the latest
+    and are dropped when their user changes (in every worker, see app.cache).
+    """
+
+    def __init__(self, backend=None):
+        self._tokens = TTLCache(AUTH_CACHE_MAX_ENTRIES, AUTH_CACHE_TTL)
+        self._generations: Dict[int, int] = {}
+        # Bumped by every invalidation, for lookups that do not know the user_id yet
+        self._epoch = 0
+        self._lock = Lock()
+        self._backend = backend or invalidation_backend("horarios:principals")
+        self._backend.start(self._drop)
+
+    def get(self, token: str) -> Optional[UserSchema]:
+        entry = self._tokens.get(token)
+        if entry is MISSING:
+            return None
+        principal, expires, generation = entry
+        if expires <= monotonic() or generation != self._generations.get(principal.user_id, 0):
+            return None
+        return principal
+
+    def generation(self) -> int:
+        """Read before loading the user and pass to set"""
+        return self._epoch
+
+    def set(self, token: str, principal: UserSchema, expires_at: Optional[int], generation: int):
+        """
+        expires_at is the token's exp claim (seconds since the epoch), if any.
+        Not stored if a user or school changed since generation was read.
+        """
+        expires = float("inf")
+        if expires_at is not None:
+            expires = monotonic() + (expires_at - datetime.now(timezone.utc).timestamp())
+        with self._lock:
+            if generation == self._epoch:
+                self._tokens.set(token, (principal, expires, self._generations.get(principal.user_id, 0)))
+
+    def invalidate(self, user_id: int):
+        self._drop([user_id])
+        self._backend.publish([user_id])
+
+    def _drop(self, user_ids):
+        with self._lock:
+            self._epoch += 1
+            for user_id in user_ids:
+                self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._tokens.clear()
+
+
+principal_cache = PrincipalCache()
+# Principals embed the user's school and its location
+reference_cache.on_invalidate("schools", principal_cache.clear)
+
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    return passwords.hash_password(password)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return passwords.verify_password(plain_password, hashed_password)[0]
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -37,7 +109,10 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_session)):
+def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_session)) -> UserSchema:
+    principal = principal_cache.get(credentials.credentials)
+    if principal is not None:
+        return principal
     try:
         payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -52,25 +127,37 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security),
             detail="Invalid authentication credentials"
         )
     
+    generation = principal_cache.generation()
     user = db.query(User).filter(User.username == username).first()
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not found"
         )
-    return user
+    principal = UserSchema.model_validate(user)
+    principal_cache.set(credentials.credentials, principal, payload.get("exp"), generation)
+    return principal
 
-def get_current_user(current_user: User = Depends(verify_token)):
+def get_current_user(current_user: UserSchema = Depends(verify_token)):
     return current_user
 
+# Async, so a login waiting for bcrypt does not hold a threadpool thread
 @router.post("/login", response_model=TokenResponse)
-def login(login_data: UserLogin, db: Session = Depends(get_session)):
-    user = db.query(User).filter(User.username == login_data.username).first()
-    if not user or not verify_password(login_data.password, user.password_hash):
+async def login(login_data: UserLogin, db: AsyncSession = Depends(get_async_session)):
+    result = await db.execute(
+        select(User).options(*load_options(User, UserSchema)).where(User.username == login_data.username)
+    )
+    user = result.scalar_one_or_none()
+    valid, new_hash = await passwords.verify_password_async(login_data.password, user.password_hash) if user else (False, None)
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password"
         )
+    if new_hash is not None:
+        # Hashed with an older BCRYPT_ROUNDS
+        user.password_hash = new_hash
+        await db.commit()
     
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
@@ -85,9 +172,9 @@ def login(login_data: UserLogin, db: Session = Depends(get_session)):
     }
 
 @router.post("/register", response_model=UserSchema)
-def register(user_data: UserCreate, db: Session = Depends(get_session)):
+async def register(user_data: UserCreate, db: AsyncSession = Depends(get_async_session)):
     # Check if username already exists
-    existing_user = db.query(User).filter(User.username == user_data.username).first()
+    existing_user = (await db.execute(select(User.user_id).where(User.username == user_data.username))).first()
     if existing_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -97,15 +184,17 @@ def register(user_data: UserCreate, db: Session = Depends(get_session)):
     # Create new user
     user_dict = user_data.model_dump()
     password = user_dict.pop('password')
-    user_dict['password_hash'] = hash_password(password)
+    user_dict['password_hash'] = await passwords.hash_password_async(password)
     
     db_user = User(**user_dict)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    result = await db.execute(
+        select(User).options(*load_options(User, UserSchema)).where(User.user_id == db_user.user_id)
+    )
     
-    return UserSchema.model_validate(db_user)
+    return UserSchema.model_validate(result.scalar_one())
 
 @router.get("/me", response_model=UserSchema)
-def get_current_user_profile(current_user: User = Depends(get_current_user)):
-    return UserSchema.model_validate(current_user)
+def get_current_user_profile(current_user: UserSchema = Depends(get_current_user)):
+    return current_user
@@ -0,0 +1,246 @@
+import csv
+import io
+import json
+from types import SimpleNamespace
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from fastapi import APIRouter, Depends, File, HTTPException, UploadFile
+from pydantic import ValidationError
+from sqlalchemy import inspect, insert, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from app.analytics import version_stats
+from app.cache import reference_cache
+from app.capacity import capacity_index
+from app.conflicts import ConflictIndex, conflict_index
+from app.database import get_session
+from app.etags import change_tracker
+from app.instrumentation import InstrumentedRoute
+from app.models import models
+from app.occupancy import room_index
+from app.schemas import classes as schemas
+
+router = APIRouter(prefix="/import", tags=["import"], route_class=InstrumentedRoute)
+
+CHUNK_SIZE = 1000
+
+# entity -> (model, create schema)
+IMPORTS = {
+    "rooms": (models.Room, schemas.RoomCreate),
+    "subjects": (models.Subject, schemas.SubjectCreate),
+    "class-groups": (models.ClassGroup, schemas.ClassGroupCreate),
+    "classes": (models.Class, schemas.ClassCreate),
+}
+
+# A parsed line: (line number, data) or (line number, error message)
+Row = Tuple[int, object]
+
+
+def read_rows(upload: UploadFile, format: str) -> Iterator[Row]:
+    """Parse an uploaded CSV or NDJSON file line by line"""
+    text = io.TextIOWrapper(upload.file, encoding="utf-8", newline="")
+    if format == "csv":
+        reader = csv.DictReader(text)
+        for record in reader:
+            data = {key: (value if value != "" else None) for key, value in record.items()}
+            if data.get("class_group_ids") is not None:
+                data["class_group_ids"] = data["class_group_ids"].replace(";", " ").replace(",", " ").split()
+            yield reader.line_num, data
+    else:
+        for line_number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield line_number, json.loads(line)
+            except ValueError as exc:
+                yield line_number, f"Invalid JSON: {exc}"
+
+
+def missing_references(db: Session, model, rows: List[Tuple[int, dict]]) -> Dict[int, List[str]]:
+    """Check every foreign key of the chunk with one query per referenced table"""
+    errors: Dict[int, List[str]] = {}
+    for column in inspect(model).columns:
+        for foreign_key in column.foreign_keys:
+            wanted = {data[column.key] for _, data in rows if data.get(column.key) is not None}
+            if not wanted:
+                continue
+            target = foreign_key.column
+            found = set(db.execute(select(target).where(target.in_(wanted))).scalars())
+            for line, data in rows:
+                if data.get(column.key) is not None and data[column.key] not in found:
+                    errors.setdefault(line, []).append(f"{column.key} {data[column.key]} does not exist")
+    return errors
+
+
+def check_classes(db: Session, rows: List[Tuple[int, dict]]) -> Dict[int, List[str]]:
+    """Class groups must exist and fit in the room, and classes may not clash with the timetable or each other"""
+    errors: Dict[int, List[str]] = {}
+    wanted = {group_id for _, data in rows for group_id in data["class_group_ids"]}
+    found = set()
+    if wanted:
+        found = set(
+            db.execute(
+                select(models.ClassGroup.class_group_id).where(models.ClassGroup.class_group_id.in_(wanted))
+            ).scalars()
+        )
+    conflict_index.ensure_loaded(db)
+    capacities = capacity_index.snapshot(db)
+    batch = ConflictIndex()
+    for line, data in rows:
+        missing = [group_id for group_id in data["class_group_ids"] if group_id not in found]
+        if missing:
+            errors.setdefault(line, []).append(f"class_group_ids {missing} do not exist")
+        excess = capacities.check(data["room_id"], data["class_group_ids"])
+        if excess is not None:
+            errors.setdefault(line, []).append(
+                f"Class groups enroll {excess[0]} students but room {data['room_id']} seats {excess[1]}"
+            )
+        candidate = SimpleNamespace(class_id=-line, **data)
+        clashes = conflict_index.find_conflicts(candidate) + batch.find_conflicts(candidate)
+        if clashes:
+            classes = sorted({clash["class_id"] for clash in clashes if clash["class_id"] > 0})
+            lines = sorted({-clash["class_id"] for clash in clashes if clash["class_id"] < 0})
+            errors.setdefault(line, []).append(
+                f"Room or teacher is already booked at this time (classes {classes}, rows {lines})"
+            )
+        elif line not in errors:
+            batch.add(candidate)
+    return errors
+
+
+def insert_chunk(db: Session, model, rows: List[Tuple[int, dict]]) -> List:
+    """Insert validated rows in one statement batch; returns new classes, if any"""
+    records = [data for _, data in rows]
+    if model is not models.Class:
+        db.execute(insert(model), records)
+        return []
+    # Class ids are needed for the group assignments, so let the ORM batch
+    # the INSERT (with RETURNING where the database supports it)
+    classes = [
+        models.Class(**{key: value for key, value in data.items() if key != "class_group_ids"})
+        for data in records
+    ]
+    db.add_all(classes)
+    db.flush()
+    assignments = [
+        {"class_id": db_class.class_id, "class_group_id": group_id}
+        for db_class, data in zip(classes, records)
+        for group_id in set(data["class_group_ids"])
+    ]
+    if assignments:
+        db.execute(insert(models.class_group_assignments), assignments)
+    return classes
+
+
+def import_chunk(db: Session, model, schema, chunk: List[Row], errors: list) -> int:
+    valid: List[Tuple[int, dict]] = []
+    for line, data in chunk:
+        if isinstance(data, str):
+            errors.append({"row": line, "errors": [data]})
+            continue
+        try:
+            valid.append((line, schema.model_validate(data).model_dump()))
+        except ValidationError as exc:
+            errors.append({
+                "row": line,
+                "errors": [f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in exc.errors()],
+            })
+
+    if model is not models.Class:
+        return insert_valid(db, model, valid, errors)
+    # Held from the conflict check until the index has the new classes
+    with conflict_index.write_locks(data.get("version_id") for _, data in valid):
+        return insert_valid(db, model, valid, errors)
+
+
+def insert_valid(db: Session, model, valid: List[Tuple[int, dict]], errors: list) -> int:
+    """Check references (and clashes, for classes) and insert what passes"""
+    row_errors = missing_references(db, model, valid)
+    if model is models.Class:
+        row_errors.update(check_classes(db, [(line, data) for line, data in valid if line not in row_errors]))
+    for line in sorted(row_errors):
+        errors.append({"row": line, "errors": row_errors[line]})
+    valid = [(line, data) for line, data in valid if line not in row_errors]
+    if not valid:
+        return 0
+
+    try:
+        classes = insert_chunk(db, model, valid)
+        db.commit()
+    except SQLAlchemyError:
+        db.rollback()
+        valid, classes = insert_rows(db, model, valid, errors)
+    for db_class in classes:
+        conflict_index.add(db_class)
+    return len(valid)
+
+
+def insert_rows(db: Session, model, rows: List[Tuple[int, dict]], errors: list):
+    """Slow path for a chunk the database rejected: insert row by row to find the culprits"""
+    inserted, classes = [], []
+    for line, data in rows:
+        savepoint = db.begin_nested()
+        try:
+            classes.extend(insert_chunk(db, model, [(line, data)]))
+            savepoint.commit()
+            inserted.append((line, data))
+        except SQLAlchemyError as exc:
+            savepoint.rollback()
+            errors.append({"row": line, "errors": [str(getattr(exc, "orig", None) or exc)]})
+    db.commit()
+    return inserted, classes
+
+
+def invalidate_imported(model):
+    """Drop what caches, indexes and ETags hold of model's table"""
+    if model is models.Room:
+        reference_cache.invalidate("rooms")
+    elif model is models.Subject:
+        reference_cache.invalidate("subjects")
+    elif model is models.ClassGroup:
+        change_tracker.bump("class_groups")
+    elif model is models.Class:
+        version_stats.invalidate()
+        room_index.invalidate_classes()
+        change_tracker.bump("classes")
+
+
+@router.post("/{entity}", response_model=schemas.ImportResult)
+def import_entities(
+    entity: str,
+    file: UploadFile = File(...),
+    format: Optional[str] = None,
+    db: Session = Depends(get_session),
+):
+    """
+    Bulk import rooms, subjects, class-groups or classes from a CSV or NDJSON
+    upload. Rows are validated and inserted in chunks, one transaction each;
+    invalid rows are reported and skipped.
+    """
+    if entity not in IMPORTS:
+        raise HTTPException(status_code=404, detail=f"Cannot import {entity}")
+    if format is None:
+        is_csv = (file.filename or "").lower().endswith(".csv") or file.content_type == "text/csv"
+        format = "csv" if is_csv else "ndjson"
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="Format must be csv or ndjson")
+    model, schema = IMPORTS[entity]
+
+    received, inserted, errors = 0, 0, []
+    chunk: List[Row] = []
+    try:
+        for row in read_rows(file, format):
+            received += 1
+            chunk.append(row)
+            if len(chunk) >= CHUNK_SIZE:
+                inserted += import_chunk(db, model, schema, chunk, errors)
+                chunk = []
+        if chunk:
+            inserted += import_chunk(db, model, schema, chunk, errors)
+    finally:
+        # Chunks committed before a failure stay, so their caches go too
+        if inserted:
+            invalidate_imported(model)
+    errors.sort(key=lambda error: error["row"])
+    return {"entity": entity, "received": received, "inserted": inserted, "errors": errors}
@@ -1,44 +1,103 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
 from sqlalchemy.orm import Session
 from app.database import get_session
+from app.instrumentation import InstrumentedRoute
+from app.etags import TIMETABLE_EVENT_TABLES, change_tracker, not_modified
+from app.models import models
 from pydantic import BaseModel
+from datetime import datetime, timezone
 from typing import List, Optional
 
-router = APIRouter(prefix="/timetable", tags=["timetable"])
+router = APIRouter(prefix="/timetable", tags=["timetable"], route_class=InstrumentedRoute)
 
-# Simple event model for demonstration
+# Calendar feed event (FullCalendar field names)
 class TimetableEvent(BaseModel):
     id: Optional[int] = None
     title: str
-    start: str
-    end: str
+    start: datetime
+    end: datetime
     backgroundColor: Optional[str] = None
     extendedProps: Optional[dict] = None
 
-# In-memory store for demo (replace with DB in production)
-events_db: List[TimetableEvent] = []
+
+def naive_utc(value: datetime) -> datetime:
+    """Times are stored as naive UTC; naive input is taken to be UTC already"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def aware_utc(value: datetime) -> datetime:
+    """Stored times go out with an explicit offset, so clients do not read them as local time"""
+    return value.replace(tzinfo=timezone.utc)
+
+
+def to_event(db_event: models.TimetableEvent) -> TimetableEvent:
+    return TimetableEvent(
+        id=db_event.event_id,
+        title=db_event.title,
+        start=aware_utc(db_event.start_at),
+        end=aware_utc(db_event.end_at),
+        backgroundColor=db_event.background_color,
+        extendedProps=db_event.extended_props,
+    )
+
+
+def apply_event(db_event: models.TimetableEvent, event: TimetableEvent):
+    start, end = naive_utc(event.start), naive_utc(event.end)
+    if start > end:
+        raise HTTPException(status_code=400, detail="Event start must not be after its end")
+    db_event.title = event.title
+    db_event.start_at = start
+    db_event.end_at = end
+    db_event.background_color = event.backgroundColor
+    db_event.extended_props = event.extendedProps
+
 
 @router.get("/events", response_model=List[TimetableEvent])
-def get_events():
-    return events_db
+def get_events(
+    request: Request,
+    response: Response,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    db: Session = Depends(get_session),
+):
+    """Events overlapping [start, end), either bound optional"""
+    cached = not_modified(request, response, TIMETABLE_EVENT_TABLES)
+    if cached:
+        return cached
+    query = db.query(models.TimetableEvent)
+    # Range scan on idx_timetable_event_range
+    if end is not None:
+        query = query.filter(models.TimetableEvent.start_at < naive_utc(end))
+    if start is not None:
+        query = query.filter(models.TimetableEvent.end_at > naive_utc(start))
+    events = query.order_by(models.TimetableEvent.start_at, models.TimetableEvent.event_id).all()
+    return [to_event(db_event) for db_event in events]
 
 @router.post("/events", response_model=TimetableEvent)
-def create_event(event: TimetableEvent):
-    event.id = len(events_db) + 1
-    events_db.append(event)
-    return event
+def create_event(event: TimetableEvent, db: Session = Depends(get_session)):
+    db_event = models.TimetableEvent()
+    apply_event(db_event, event)
+    db.add(db_event)
+    db.commit()
+    change_tracker.bump("timetable_events")
+    return to_event(db_event)
 
 @router.put("/events/{event_id}", response_model=TimetableEvent)
-def update_event(event_id: int, event: TimetableEvent):
-    for idx, e in enumerate(events_db):
-        if e.id == event_id:
-            events_db[idx] = event
-            events_db[idx].id = event_id
-            return events_db[idx]
-    raise HTTPException(status_code=404, detail="Event not found")
+def update_event(event_id: int, event: TimetableEvent, db: Session = Depends(get_session)):
+    db_event = db.get(models.TimetableEvent, event_id)
+    if db_event is None:
+        raise HTTPException(status_code=404, detail="Event not found")
+    apply_event(db_event, event)
+    db.commit()
+    change_tracker.bump("timetable_events")
+    return to_event(db_event)
 
 @router.delete("/events/{event_id}")
-def delete_event(event_id: int):
-    global events_db
-    events_db = [e for e in events_db if e.id != event_id]
-    return {"message": "Event deleted"} 
\ No newline at end of file
+def delete_event(event_id: int, db: Session = Depends(get_session)):
+    deleted = db.query(models.TimetableEvent).filter(models.TimetableEvent.event_id == event_id).delete()
+    db.commit()
+    if deleted:
+        change_tracker.bump("timetable_events")
+    return {"message": "Event deleted"}
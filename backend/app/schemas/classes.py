@@ -1,3 +1,4 @@
+import datetime as dt
 from datetime import datetime, date, time
 from typing import Optional, List
 from pydantic import BaseModel, ConfigDict
@@ -221,6 +222,12 @@ class TimetableVersionUpdate(BaseModel):
     description: Optional[str] = None
 
 
+class TimetableVersionClone(BaseModel):
+    created_by: int
+    phase: Optional[TimetablePhase] = None  # Defaults to the source version's phase
+    description: Optional[str] = None
+
+
 class TimetableVersion(TimetableVersionBase):
     model_config = ConfigDict(from_attributes=True)
     version_id: int
@@ -234,7 +241,7 @@ class ClassBase(BaseModel):
     teacher_id: int
     room_id: int
     day_of_week: Optional[int] = None
-    date: Optional[date] = None
+    date: Optional[dt.date] = None
     start_time: time
     end_time: time
     is_recurring: bool = True
@@ -252,7 +259,7 @@ class ClassUpdate(BaseModel):
     teacher_id: Optional[int] = None
     room_id: Optional[int] = None
     day_of_week: Optional[int] = None
-    date: Optional[date] = None
+    date: Optional[dt.date] = None
     start_time: Optional[time] = None
     end_time: Optional[time] = None
     is_recurring: Optional[bool] = None
@@ -274,7 +281,7 @@ class Class(ClassBase):
 class UnavailabilityBase(BaseModel):
     teacher_id: int
     day_of_week: Optional[int] = None
-    date: Optional[date] = None
+    date: Optional[dt.date] = None
     start_time: Optional[time] = None
     end_time: Optional[time] = None
     is_full_day: bool = False
@@ -287,7 +294,7 @@ class UnavailabilityCreate(UnavailabilityBase):
 class UnavailabilityUpdate(BaseModel):
     teacher_id: Optional[int] = None
     day_of_week: Optional[int] = None
-    date: Optional[date] = None
+    date: Optional[dt.date] = None
     start_time: Optional[time] = None
     end_time: Optional[time] = None
     is_full_day: Optional[bool] = None
@@ -353,3 +360,157 @@ class Approval(ApprovalBase):
     requester: Optional[User] = None
     approver: Optional[User] = None
     class_: Optional[Class] = None
+
+
+class ConflictKind(str, Enum):
+    room = "room"
+    teacher = "teacher"
+    class_group = "class_group"
+    unavailability = "unavailability"
+
+
+class Conflict(BaseModel):
+    kind: ConflictKind
+    resource_id: int
+    class_ids: List[int]
+    unavailability_id: Optional[int] = None
+    day_of_week: int
+    date: Optional[dt.date]
+    start_time: time
+    end_time: time
+
+
+class ConflictReport(BaseModel):
+    version_id: int
+    class_count: int
+    conflicts: List[Conflict]
+
+
+class OverCapacityClass(BaseModel):
+    class_id: int
+    room_id: int
+    class_group_ids: List[int]
+    enrolled: int
+    capacity: int
+
+
+class OverCapacityReport(BaseModel):
+    version_id: int
+    class_count: int
+    classes: List[OverCapacityClass]
+
+
+class TeacherWorkload(BaseModel):
+    teacher_id: int
+    weekly_hours: float
+    one_off_hours: float
+    class_count: int
+
+
+class RoomUtilization(BaseModel):
+    room_id: int
+    weekly_hours: float
+    one_off_hours: float
+    class_count: int
+    occupancy_percent: float  # weekly hours against the teaching week
+    seat_utilization_percent: float  # enrolled against capacity, weighted by duration
+    over_capacity_classes: int
+
+
+class VersionStats(BaseModel):
+    version_id: int
+    class_count: int
+    teaching_week_hours: float
+    seat_utilization_percent: float
+    teachers: List[TeacherWorkload]
+    rooms: List[RoomUtilization]
+
+
+class ClassRequest(BaseModel):
+    subject_id: int
+    class_type: ClassType
+    teacher_id: int
+    duration_minutes: int
+    class_group_ids: List[int] = []
+    room_id: Optional[int] = None
+
+
+class SchedulingOptions(BaseModel):
+    days: List[int] = [1, 2, 3, 4, 5]
+    day_start: time = time(8, 0)
+    day_end: time = time(20, 0)
+    slot_minutes: int = 30
+    seed: int = 0
+
+
+class TimetableGenerationRequest(SchedulingOptions):
+    classes: List[ClassRequest]
+
+
+class UnscheduledClass(BaseModel):
+    index: int
+    reason: str
+
+
+class TimetableGenerationResult(BaseModel):
+    version_id: int
+    scheduled: List[Class]
+    unscheduled: List[UnscheduledClass]
+
+
+class TimetableRepairRequest(SchedulingOptions):
+    class_ids: List[int] = []
+    room_ids: List[int] = []
+    teacher_ids: List[int] = []
+    apply: bool = True
+
+
+class ClassPlacement(BaseModel):
+    day_of_week: int
+    start_time: time
+    end_time: time
+    room_id: int
+
+
+class ClassChange(BaseModel):
+    class_id: int
+    before: ClassPlacement
+    after: ClassPlacement
+
+
+class UnresolvedClass(BaseModel):
+    class_id: int
+    reason: str
+
+
+class TimetableRepairResult(BaseModel):
+    version_id: int
+    checked: int
+    changes: List[ClassChange]
+    unresolved: List[UnresolvedClass]
+
+
+class ImportRowError(BaseModel):
+    row: int
+    errors: List[str]
+
+
+class ImportResult(BaseModel):
+    entity: str
+    received: int
+    inserted: int
+    errors: List[ImportRowError]
+
+
+class Occurrence(BaseModel):
+    class_id: int
+    date: dt.date
+    start_time: time
+    end_time: time
+    subject_id: int
+    class_type: ClassType
+    teacher_id: int
+    room_id: int
+    class_group_ids: List[int]
+    version_id: Optional[int] = None
+    is_recurring: bool
@@ -0,0 +1,551 @@
+"""
+Automatic timetable generation.
+
+Places unscheduled classes into a timetable version: every class gets a
+weekday, a start time and a room that respect room capacity and ownership,
+class group location, teacher unavailability and the bookings already in the
+version. Occupancy is loaded through app.occupancy and kept as one bitmap
+per (resource, weekday), so testing a slot is a shift and an AND.
+
+The search itself (`solve`) is a pure function over picklable data and runs
+in a process pool, keeping the CPU work off the API threads.
+"""
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+
+from app.conflicts import minutes_to_time, to_minutes
+from app.models import models
+from app.occupancy import GROUP, ROOM, SLOT_MINUTES, TEACHER, OccupancyGrid
+
+# Grid resolution; start times are aligned to multiples of this
+UNIT_MINUTES = SLOT_MINUTES
+
+# (kind, resource_id, weekday), kind being ROOM, TEACHER or GROUP
+ResourceKey = Tuple[str, int, int]
+
+
+@dataclass
+class RoomInfo:
+    room_id: int
+    capacity: int
+    location_id: int
+    owner_course_id: Optional[int] = None
+
+
+@dataclass
+class Task:
+    """A class that still needs a weekday, a start time and a room"""
+
+    index: int
+    teacher_id: int
+    course_id: int
+    length: int  # in grid units
+    group_ids: Tuple[int, ...] = ()
+    enrollment: int = 0
+    location_ids: FrozenSet[int] = frozenset()
+    room_id: Optional[int] = None  # fixed room, if requested
+
+
+@dataclass
+class Problem:
+    tasks: List[Task]
+    rooms: List[RoomInfo]
+    days: List[int]
+    first_unit: int
+    last_unit: int
+    step: int  # start time granularity in grid units
+    busy: Dict[ResourceKey, int] = field(default_factory=dict)
+    seed: int = 0
+    max_ejections: int = 200
+
+
+@dataclass
+class Solution:
+    # task index -> (weekday, start unit, room_id)
+    placements: Dict[int, Tuple[int, int, int]] = field(default_factory=dict)
+    # task index -> reason
+    unplaced: Dict[int, str] = field(default_factory=dict)
+
+
+def eligible_rooms(task: Task, rooms: List[RoomInfo]) -> List[RoomInfo]:
+    """Rooms that fit the task, smallest sufficient capacity first"""
+    candidates = [
+        room
+        for room in rooms
+        if room.capacity >= task.enrollment
+        and (room.owner_course_id is None or room.owner_course_id == task.course_id)
+        and (not task.location_ids or room.location_id in task.location_ids)
+        and (task.room_id is None or room.room_id == task.room_id)
+    ]
+    return sorted(candidates, key=lambda room: (room.capacity, room.room_id))
+
+
+class _Grid:
+    """Occupancy bitmaps plus the tasks placed on each of them"""
+
+    def __init__(self, busy: Dict[ResourceKey, int]):
+        self.bits: Dict[ResourceKey, int] = dict(busy)
+        self.owners: Dict[ResourceKey, Dict[int, int]] = {}
+
+    @staticmethod
+    def keys(task: Task, day: int, room_id: int) -> List[ResourceKey]:
+        keys = [(ROOM, room_id, day), (TEACHER, task.teacher_id, day)]
+        keys.extend((GROUP, group_id, day) for group_id in task.group_ids)
+        return keys
+
+    def blockers(self, keys: List[ResourceKey], mask: int) -> Optional[set]:
+        """Tasks occupying mask on keys, or None if a fixed booking does"""
+        found = set()
+        for key in keys:
+            taken = self.bits.get(key, 0) & mask
+            if not taken:
+                continue
+            for index, owned in self.owners.get(key, {}).items():
+                if owned & taken:
+                    found.add(index)
+                    taken &= ~owned
+            if taken:
+                return None
+        return found
+
+    def place(self, index: int, keys: List[ResourceKey], mask: int):
+        for key in keys:
+            self.bits[key] = self.bits.get(key, 0) | mask
+            self.owners.setdefault(key, {})[index] = mask
+
+    def release(self, index: int, keys: List[ResourceKey], mask: int):
+        for key in keys:
+            self.bits[key] &= ~mask
+            self.owners[key].pop(index, None)
+
+
+class _Search:
+    def __init__(self, problem: Problem):
+        self.problem = problem
+        self.grid = _Grid(problem.busy)
+        self.rooms = {task.index: eligible_rooms(task, problem.rooms) for task in problem.tasks}
+        self.tasks = {task.index: task for task in problem.tasks}
+        self.placed: Dict[int, Tuple[int, int, int]] = {}
+        self.day_load: Dict[ResourceKey, int] = {}
+        self.random = random.Random(problem.seed)
+
+    def _mask(self, task: Task, start: int) -> int:
+        return ((1 << task.length) - 1) << start
+
+    @staticmethod
+    def _people(task: Task, day: int) -> List[ResourceKey]:
+        return [(TEACHER, task.teacher_id, day)] + [
+            (GROUP, group_id, day) for group_id in task.group_ids
+        ]
+
+    def _candidates(self, task: Task):
+        problem = self.problem
+        last_start = problem.last_unit - task.length
+        for day in problem.days:
+            for start in range(problem.first_unit, last_start + 1, problem.step):
+                for room in self.rooms[task.index]:
+                    yield day, start, room
+
+    def _cost(self, task: Task, day: int, start: int, room: RoomInfo) -> float:
+        # Spread each teacher's and group's classes over the week, prefer
+        # earlier slots and the tightest room that fits
+        load = sum(self.day_load.get(key, 0) for key in self._people(task, day))
+        waste = (room.capacity - task.enrollment) / room.capacity
+        return load * 4 + start / self.problem.last_unit + waste
+
+    def _assign(self, task: Task, day: int, start: int, room_id: int):
+        self.grid.place(task.index, self.grid.keys(task, day, room_id), self._mask(task, start))
+        self.placed[task.index] = (day, start, room_id)
+        for key in self._people(task, day):
+            self.day_load[key] = self.day_load.get(key, 0) + task.length
+
+    def _unassign(self, task: Task):
+        day, start, room_id = self.placed.pop(task.index)
+        self.grid.release(task.index, self.grid.keys(task, day, room_id), self._mask(task, start))
+        for key in self._people(task, day):
+            self.day_load[key] -= task.length
+
+    def place_greedy(self, task: Task) -> bool:
+        problem, bits = self.problem, self.grid.bits
+        rooms = self.rooms[task.index]
+        best, best_cost = None, None
+        for day in problem.days:
+            people = 0
+            for key in self._people(task, day):
+                people |= bits.get(key, 0)
+            for start in range(problem.first_unit, problem.last_unit - task.length + 1, problem.step):
+                mask = self._mask(task, start)
+                if people & mask:
+                    continue
+                # Rooms are sorted by capacity, so the first free one fits best
+                room = next(
+                    (room for room in rooms if not bits.get((ROOM, room.room_id, day), 0) & mask),
+                    None,
+                )
+                if room is None:
+                    continue
+                cost = self._cost(task, day, start, room)
+                if best_cost is None or cost < best_cost:
+                    best, best_cost = (day, start, room.room_id), cost
+        if best is None:
+            return False
+        self._assign(task, *best)
+        return True
+
+    def place_with_ejection(self, task: Task) -> bool:
+        """Take a slot held by a single placed task and move that task elsewhere"""
+        options = []
+        for day, start, room in self._candidates(task):
+            keys = self.grid.keys(task, day, room.room_id)
+            blockers = self.grid.blockers(keys, self._mask(task, start))
+            if blockers is not None and len(blockers) == 1:
+                options.append((day, start, room.room_id, blockers.pop()))
+        self.random.shuffle(options)
+        for day, start, room_id, blocker_index in options:
+            blocker = self.tasks[blocker_index]
+            previous = self.placed[blocker_index]
+            self._unassign(blocker)
+            self._assign(task, day, start, room_id)
+            if self.place_greedy(blocker):
+                return True
+            self._unassign(task)
+            self._assign(blocker, *previous)
+        return False
+
+    def run(self) -> Solution:
+        solution = Solution()
+        # Most constrained first: fewest rooms, then longest
+        order = sorted(
+            self.problem.tasks,
+            key=lambda task: (len(self.rooms[task.index]), -task.length, task.index),
+        )
+        pending = []
+        for task in order:
+            if not self.rooms[task.index]:
+                solution.unplaced[task.index] = "No room satisfies capacity, location and ownership"
+            elif task.length > self.problem.last_unit - self.problem.first_unit:
+                solution.unplaced[task.index] = "Class is longer than the scheduling window"
+            elif not self.place_greedy(task):
+                pending.append(task)
+
+        ejections = self.problem.max_ejections
+        for task in pending:
+            if ejections > 0 and self.place_with_ejection(task):
+                ejections -= 1
+                continue
+            solution.unplaced[task.index] = "No free slot for room, teacher and class groups"
+
+        solution.placements = dict(self.placed)
+        return solution
+
+    def place_at(self, task: Task, day: int, start: int, rooms: List[RoomInfo]) -> bool:
+        """Place task at a fixed day and start in the first free room given"""
+        bits, mask = self.grid.bits, self._mask(task, start)
+        if any(bits.get(key, 0) & mask for key in self._people(task, day)):
+            return False
+        for room in rooms:
+            if not bits.get((ROOM, room.room_id, day), 0) & mask:
+                self._assign(task, day, start, room.room_id)
+                return True
+        return False
+
+    def repair(self, current: Dict[int, Tuple[int, int, int]]) -> Solution:
+        """
+        Re-validate already scheduled tasks, moving as little as possible:
+        keep a task where it is if it still fits, otherwise try another room
+        at the same time, and only then look for a new slot.
+        """
+        solution = Solution()
+        moved = []
+        for task in sorted(self.problem.tasks, key=lambda task: task.index):
+            day, start, room_id = current[task.index]
+            rooms = self.rooms[task.index]
+            kept = [room for room in rooms if room.room_id == room_id]
+            if not (kept and self.place_at(task, day, start, kept)):
+                moved.append(task)
+        # A task that cannot be moved stays where it is, so hold every
+        # original slot until its own task has been dealt with
+        holds = {}
+        for task in moved:
+            day, start, room_id = current[task.index]
+            holds[task.index] = (self.grid.keys(task, day, room_id), self._mask(task, start))
+            self.grid.place(task.index, *holds[task.index])
+        for task in moved:
+            day, start, _ = current[task.index]
+            self.grid.release(task.index, *holds[task.index])
+            if not self.rooms[task.index]:
+                solution.unplaced[task.index] = "No room satisfies capacity, location and ownership"
+            elif not (self.place_at(task, day, start, self.rooms[task.index]) or self.place_greedy(task)):
+                solution.unplaced[task.index] = "No free slot for room, teacher and class groups"
+            else:
+                continue
+            self.grid.place(task.index, *holds[task.index])
+        solution.placements = dict(self.placed)
+        return solution
+
+
+def solve(problem: Problem) -> Solution:
+    """Greedy placement followed by single-task ejection repair"""
+    return _Search(problem).run()
+
+
+def repair(problem: Problem, current: Dict[int, Tuple[int, int, int]]) -> Solution:
+    """Incremental counterpart of solve for tasks that already have a placement"""
+    return _Search(problem).repair(current)
+
+
+# Seconds a generate request waits for the solver pool
+SOLVER_TIMEOUT = float(os.getenv("SOLVER_TIMEOUT", "30"))
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_solver_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=int(os.getenv("SOLVER_WORKERS", "2")))
+    return _pool
+
+
+def units(minutes: int) -> int:
+    """Minutes to grid units, rounding up"""
+    return -(-minutes // UNIT_MINUTES)
+
+
+def load_busy(
+    db: Session, version_id: int, days: List[int], exclude_class_ids=()
+) -> Dict[ResourceKey, int]:
+    """
+    Weekly occupancy of rooms, teachers and class groups already booked in
+    the version: recurring classes and recurring unavailabilities only.
+    Dated classes and one-day absences are ignored rather than blocking
+    their slot in every week of the generated recurring timetable; a clash
+    with one of them shows up in the version's conflict report.
+    """
+    grid = OccupancyGrid.from_db(db, version_id, exclude_class_ids)
+    busy: Dict[ResourceKey, int] = {}
+    for kind in (ROOM, TEACHER, GROUP):
+        for resource_id in grid.resources(kind):
+            for day in days:
+                mask = grid.day_mask(kind, resource_id, day, dated=False)
+                if mask:
+                    busy[(kind, resource_id, day)] = mask
+    return busy
+
+
+def build_problem(db: Session, version_id: int, request) -> Problem:
+    """Collect everything the solver needs from the database into plain data"""
+    subject_ids = {item.subject_id for item in request.classes}
+    course_by_subject = dict(
+        db.query(models.Subject.subject_id, models.Subject.course_id)
+        .filter(models.Subject.subject_id.in_(subject_ids))
+        .all()
+    )
+    group_ids = {group_id for item in request.classes for group_id in item.class_group_ids}
+    groups = {
+        class_group_id: (enrollment_count, location_id)
+        for class_group_id, enrollment_count, location_id in db.query(
+            models.ClassGroup.class_group_id,
+            models.ClassGroup.enrollment_count,
+            models.ClassGroup.location_id,
+        )
+        .filter(models.ClassGroup.class_group_id.in_(group_ids))
+        .all()
+    }
+    rooms = [
+        RoomInfo(*row)
+        for row in db.query(
+            models.Room.room_id,
+            models.Room.capacity,
+            models.Room.location_id,
+            models.Room.owner_course_id,
+        ).all()
+    ]
+
+    tasks = []
+    for index, item in enumerate(request.classes):
+        item_groups = [groups[group_id] for group_id in item.class_group_ids if group_id in groups]
+        tasks.append(
+            Task(
+                index=index,
+                teacher_id=item.teacher_id,
+                course_id=course_by_subject.get(item.subject_id),
+                length=units(item.duration_minutes),
+                group_ids=tuple(item.class_group_ids),
+                enrollment=sum(enrollment for enrollment, _ in item_groups),
+                location_ids=frozenset(location_id for _, location_id in item_groups),
+                room_id=item.room_id,
+            )
+        )
+
+    days = sorted(set(request.days))
+    return Problem(
+        tasks=tasks,
+        rooms=rooms,
+        days=days,
+        first_unit=to_minutes(request.day_start) // UNIT_MINUTES,
+        last_unit=to_minutes(request.day_end) // UNIT_MINUTES,
+        step=max(1, units(request.slot_minutes)),
+        busy=load_busy(db, version_id, days),
+        seed=request.seed,
+    )
+
+
+def build_classes(db: Session, version_id: int, request, solution: Solution) -> List[models.Class]:
+    """Turn the solver's placements into (unsaved) recurring classes"""
+    group_ids = {group_id for item in request.classes for group_id in item.class_group_ids}
+    groups = {
+        group.class_group_id: group
+        for group in db.query(models.ClassGroup)
+        .filter(models.ClassGroup.class_group_id.in_(group_ids))
+        .all()
+    }
+    classes = []
+    for index, (day, start, room_id) in sorted(solution.placements.items()):
+        item = request.classes[index]
+        start_minutes = start * UNIT_MINUTES
+        db_class = models.Class(
+            subject_id=item.subject_id,
+            class_type=item.class_type,
+            teacher_id=item.teacher_id,
+            room_id=room_id,
+            day_of_week=day,
+            start_time=minutes_to_time(start_minutes),
+            end_time=minutes_to_time(start_minutes + units(item.duration_minutes) * UNIT_MINUTES),
+            is_recurring=True,
+            version_id=version_id,
+        )
+        db_class.class_groups = [groups[group_id] for group_id in item.class_group_ids if group_id in groups]
+        classes.append(db_class)
+    return classes
+
+
+def build_repair_problem(db: Session, version_id: int, request):
+    """
+    Collect the recurring classes touched by the changed rooms, teachers or
+    classes as repair tasks (indexed by class_id), with everything else in
+    the version as fixed occupancy. Returns (problem, current placements,
+    classes by id).
+    """
+    conditions = []
+    if request.class_ids:
+        conditions.append(models.Class.class_id.in_(request.class_ids))
+    if request.room_ids:
+        conditions.append(models.Class.room_id.in_(request.room_ids))
+    if request.teacher_ids:
+        conditions.append(models.Class.teacher_id.in_(request.teacher_ids))
+    affected = []
+    if conditions:
+        affected = (
+            db.query(models.Class)
+            .filter(
+                models.Class.version_id == version_id,
+                models.Class.day_of_week.isnot(None),
+                models.Class.approval_status != models.ApprovalStatus.rejected,
+                or_(*conditions),
+            )
+            .all()
+        )
+    classes = {db_class.class_id: db_class for db_class in affected}
+
+    course_by_subject = dict(
+        db.query(models.Subject.subject_id, models.Subject.course_id)
+        .filter(models.Subject.subject_id.in_({c.subject_id for c in affected}))
+        .all()
+    )
+    groups_by_class: Dict[int, list] = {}
+    for class_id, class_group_id, enrollment_count, location_id in (
+        db.query(
+            models.class_group_assignments.c.class_id,
+            models.ClassGroup.class_group_id,
+            models.ClassGroup.enrollment_count,
+            models.ClassGroup.location_id,
+        )
+        .join(
+            models.ClassGroup,
+            models.ClassGroup.class_group_id == models.class_group_assignments.c.class_group_id,
+        )
+        .filter(models.class_group_assignments.c.class_id.in_(list(classes)))
+        .all()
+    ):
+        groups_by_class.setdefault(class_id, []).append((class_group_id, enrollment_count, location_id))
+
+    rooms = [
+        RoomInfo(*row)
+        for row in db.query(
+            models.Room.room_id,
+            models.Room.capacity,
+            models.Room.location_id,
+            models.Room.owner_course_id,
+        ).all()
+    ]
+
+    tasks, current = [], {}
+    for class_id, db_class in classes.items():
+        start_minutes = to_minutes(db_class.start_time)
+        start = start_minutes // UNIT_MINUTES
+        groups = groups_by_class.get(class_id, [])
+        tasks.append(
+            Task(
+                index=class_id,
+                teacher_id=db_class.teacher_id,
+                course_id=course_by_subject.get(db_class.subject_id),
+                length=units(to_minutes(db_class.end_time)) - start,
+                group_ids=tuple(group_id for group_id, _, _ in groups),
+                enrollment=sum(enrollment for _, enrollment, _ in groups),
+                location_ids=frozenset(location_id for _, _, location_id in groups),
+            )
+        )
+        current[class_id] = (db_class.day_of_week, start, db_class.room_id)
+
+    days = sorted(set(request.days) | {day for day, _, _ in current.values()})
+    problem = Problem(
+        tasks=tasks,
+        rooms=rooms,
+        days=days,
+        first_unit=to_minutes(request.day_start) // UNIT_MINUTES,
+        last_unit=to_minutes(request.day_end) // UNIT_MINUTES,
+        step=max(1, units(request.slot_minutes)),
+        busy=load_busy(db, version_id, days, exclude_class_ids=classes),
+        seed=request.seed,
+    )
+    return problem, current, classes
+
+
+def repair_changes(classes: Dict[int, models.Class], current, solution: Solution) -> List[dict]:
+    """
+    Apply moved placements to the classes and describe them as a diff.
+    A moved class keeps its duration; an unchanged one is left untouched.
+    """
+    changes = []
+    for class_id, placement in sorted(solution.placements.items()):
+        if placement == current[class_id]:
+            continue
+        db_class = classes[class_id]
+        before = {
+            "day_of_week": db_class.day_of_week,
+            "start_time": db_class.start_time,
+            "end_time": db_class.end_time,
+            "room_id": db_class.room_id,
+        }
+        day, start, room_id = placement
+        if (day, start) != current[class_id][:2]:
+            duration = to_minutes(db_class.end_time) - to_minutes(db_class.start_time)
+            db_class.day_of_week = day
+            db_class.start_time = minutes_to_time(start * UNIT_MINUTES)
+            db_class.end_time = minutes_to_time(start * UNIT_MINUTES + duration)
+        db_class.room_id = room_id
+        after = {
+            "day_of_week": db_class.day_of_week,
+            "start_time": db_class.start_time,
+            "end_time": db_class.end_time,
+            "room_id": db_class.room_id,
+        }
+        changes.append({"class_id": class_id, "before": before, "after": after})
+    return changes
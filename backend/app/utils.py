@@ -1,17 +1,15 @@
-from passlib.context import CryptContext
 from typing import Optional
 from sqlmodel import Session
+from app import passwords
 from app.models.models import User
 
-pwd_context = CryptContext(schemes=["bcrypt"])
-
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return passwords.hash_password(password)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return passwords.verify_password(plain_password, hashed_password)[0]
 
 
 def get_user(db: Session, email: str) -> Optional[User]:
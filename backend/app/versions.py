@@ -0,0 +1,81 @@
+"""
+Cloning a timetable version.
+
+Classes and their class group assignments are copied with two set-based
+INSERT ... SELECT statements, so the rows never leave the database. New class
+ids are the source ids shifted past the current maximum by a fixed offset,
+which lets the assignment copy apply the same shift instead of looking up
+which new class came from which old one.
+
+Schedules read without naming a version (occurrences, calendar feeds) show
+the current version only, so a clone does not list every class twice.
+"""
+from typing import Optional
+
+from sqlalchemy import func, insert, literal, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.models import models
+
+
+def clone_classes(db: Session, source_version_id: int, target_version_id: int) -> int:
+    """Copy every class of source_version_id into target_version_id; the caller commits"""
+    classes = models.Class.__table__
+    low = db.scalar(select(func.min(classes.c.class_id)).where(classes.c.version_id == source_version_id))
+    if low is None:
+        return 0
+    # The copies land right after the highest class id in use
+    offset = db.scalar(select(func.max(classes.c.class_id))) - low + 1
+
+    columns = []
+    for column in classes.columns:
+        if column.key == "class_id":
+            columns.append(column + offset)
+        elif column.key == "version_id":
+            columns.append(literal(target_version_id))
+        else:
+            columns.append(column)
+    copied = db.execute(
+        insert(classes).from_select(
+            [column.key for column in classes.columns],
+            select(*columns).where(classes.c.version_id == source_version_id),
+        )
+    ).rowcount
+
+    assignments = models.class_group_assignments
+    db.execute(
+        insert(assignments).from_select(
+            ["class_id", "class_group_id"],
+            select(assignments.c.class_id + offset, assignments.c.class_group_id)
+            .join(classes, classes.c.class_id == assignments.c.class_id)
+            .where(classes.c.version_id == source_version_id),
+        )
+    )
+    return copied
+
+
+def is_id_collision(error: IntegrityError) -> bool:
+    """Whether a clone failed because another write took its class ids first"""
+    args = getattr(error.orig, "args", ())
+    # MySQL reports any duplicate key as ER_DUP_ENTRY; the copies only have primary keys
+    if args and args[0] == 1062:
+        return True
+    message = str(error.orig)
+    return message.startswith((
+        "UNIQUE constraint failed: classes.class_id",
+        "UNIQUE constraint failed: class_group_assignments.",
+    ))
+
+
+def current_version_id(db: Session) -> Optional[int]:
+    """The newest version in the adjustment phase, else the newest version; None if there are none"""
+    return db.scalar(
+        select(models.TimetableVersion.version_id)
+        .order_by(
+            (models.TimetableVersion.phase == models.TimetablePhase.adjustment).desc(),
+            models.TimetableVersion.creation_date.desc(),
+            models.TimetableVersion.version_id.desc(),
+        )
+        .limit(1)
+    )
@@ -0,0 +1 @@
+"""Reproducible in-process benchmarks of the API's hot endpoints; see __main__.py"""
@@ -0,0 +1,54 @@
+"""
+Stored benchmark results and the comparison that fails a run.
+
+Latency and throughput may drift by --tolerance (a fraction) before they
+count as a regression, and small absolute differences are ignored as noise.
+Queries per request are deterministic, so any increase is a regression.
+"""
+import json
+from pathlib import Path
+from typing import Dict, List
+
+from benchmarks.scenarios import Result
+
+# Run settings that must match for results to be comparable
+META_KEYS = ("scale", "database", "concurrency", "seed")
+LATENCY_FIELDS = ("p50_ms", "p95_ms", "p99_ms")
+MIN_LATENCY_DELTA_MS = 1.0
+QUERY_DELTA = 0.01
+
+
+def load(path: Path) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(path: Path, meta: Dict[str, object], results: List[Result]):
+    data = {"meta": meta, "scenarios": {result.name: result.as_dict() for result in results}}
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def mismatched_meta(baseline: dict, meta: Dict[str, object]) -> List[str]:
+    stored = baseline.get("meta", {})
+    return [f"{key}: baseline {stored.get(key)!r}, run {meta[key]!r}" for key in META_KEYS if stored.get(key) != meta[key]]
+
+
+def regressions(baseline: dict, results: List[Result], tolerance: float) -> List[str]:
+    found = []
+    for result in results:
+        stored = baseline.get("scenarios", {}).get(result.name)
+        if stored is None:
+            continue
+        for field in LATENCY_FIELDS:
+            before, after = stored[field], getattr(result, field)
+            if after > before * (1 + tolerance) and after - before > MIN_LATENCY_DELTA_MS:
+                found.append(f"{result.name}: {field} {before:.1f} -> {after:.1f}")
+        before, after = stored["throughput_rps"], result.throughput_rps
+        if after < before / (1 + tolerance):
+            found.append(f"{result.name}: throughput {before:.1f} -> {after:.1f} req/s")
+        before, after = stored["queries_per_request"], result.queries_per_request
+        if after > before + QUERY_DELTA:
+            found.append(f"{result.name}: queries per request {before:.2f} -> {after:.2f}")
+    return found
@@ -0,0 +1,188 @@
+"""
+Synthetic timetable data for the benchmarks.
+
+Rows are generated from a seeded random.Random, so the same scale and seed
+always produce the same database, and bulk inserted with explicit primary
+keys through the real models. Within each timetable version no two classes
+share a room slot; teachers, groups and approval states are spread at random.
+"""
+from datetime import date, datetime, time, timedelta
+from random import Random
+from typing import Dict, List, NamedTuple
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from app import passwords
+from app.models import models
+
+PASSWORD = "benchmark"
+FIRST_HOUR = 8
+LAST_HOUR = 20
+DAYS = range(1, 6)
+
+
+class Scale(NamedTuple):
+    locations: int
+    schools: int
+    courses: int
+    rooms: int
+    subjects: int
+    teachers: int
+    classes: int
+    versions: int
+    approvals: int
+
+
+SCALES: Dict[str, Scale] = {
+    "full": Scale(locations=3, schools=6, courses=40, rooms=50, subjects=2000, teachers=500,
+                  classes=20000, versions=8, approvals=3000),
+    "small": Scale(locations=3, schools=3, courses=10, rooms=20, subjects=200, teachers=50,
+                   classes=2000, versions=2, approvals=300),
+}
+
+
+class World(NamedTuple):
+    """Ids the scenarios pick from"""
+    admin_id: int
+    class_count: int
+    usernames: List[str]
+    room_ids: List[int]
+    version_ids: List[int]
+    pending_approval_ids: List[int]
+
+
+def _bulk(db: Session, model, rows: List[dict]):
+    if rows:
+        db.execute(insert(model), rows)
+
+
+def populate(db: Session, scale: Scale, seed: int = 0) -> World:
+    """Fill an empty database; returns the ids the scenarios need"""
+    rng = Random(seed)
+    # One bcrypt hash for everyone, at the configured BCRYPT_ROUNDS
+    password_hash = passwords.hash_password(PASSWORD)
+
+    _bulk(db, models.Location, [
+        {"location_id": i, "name": f"Campus {i}", "is_campus": i == 1}
+        for i in range(1, scale.locations + 1)
+    ])
+    _bulk(db, models.School, [
+        {"school_id": i, "name": f"School {i}", "location_id": (i - 1) % scale.locations + 1}
+        for i in range(1, scale.schools + 1)
+    ])
+    _bulk(db, models.Course, [
+        {"course_id": i, "name": f"Course {i}", "school_id": (i - 1) % scale.schools + 1,
+         "is_short_course": rng.random() < 0.1}
+        for i in range(1, scale.courses + 1)
+    ])
+    _bulk(db, models.Subject, [
+        {"subject_id": i, "name": f"Subject {i}", "course_id": rng.randint(1, scale.courses)}
+        for i in range(1, scale.subjects + 1)
+    ])
+
+    rooms = []
+    for i in range(1, scale.rooms + 1):
+        rooms.append({
+            "room_id": i, "name": f"Room {i}", "capacity": rng.choice((20, 30, 40, 60, 80, 120, 200)),
+            "location_id": (i - 1) % scale.locations + 1,
+            "owner_course_id": rng.randint(1, scale.courses) if rng.random() < 0.2 else None,
+        })
+    _bulk(db, models.Room, rooms)
+
+    admin_id = 1
+    users = [{"user_id": admin_id, "username": "admin", "password_hash": password_hash,
+              "role": models.UserRole.Administrator, "school_id": None}]
+    for i in range(2, scale.teachers + 2):
+        users.append({"user_id": i, "username": f"teacher{i - 1}", "password_hash": password_hash,
+                      "role": models.UserRole.Teacher, "school_id": rng.randint(1, scale.schools)})
+    _bulk(db, models.User, users)
+    teacher_ids = [user["user_id"] for user in users[1:]]
+
+    unavailabilities = []
+    for teacher_id in teacher_ids:
+        for _ in range(rng.randint(1, 3)):
+            row = {"teacher_id": teacher_id, "day_of_week": rng.choice(DAYS), "is_full_day": rng.random() < 0.3,
+                   "start_time": None, "end_time": None}
+            if not row["is_full_day"]:
+                start = rng.randrange(FIRST_HOUR, LAST_HOUR - 1)
+                row["start_time"] = time(start)
+                row["end_time"] = time(start + rng.randint(1, 3))
+            unavailabilities.append(row)
+    _bulk(db, models.Unavailability, unavailabilities)
+
+    # One to three groups per subject
+    groups: Dict[int, List[int]] = {}
+    group_rows = []
+    for subject_id in range(1, scale.subjects + 1):
+        for number in range(1, rng.randint(1, 3) + 1):
+            class_group_id = len(group_rows) + 1
+            group_rows.append({
+                "class_group_id": class_group_id, "subject_id": subject_id, "group_number": number,
+                "enrollment_count": rng.randint(10, 120), "location_id": rng.randint(1, scale.locations),
+            })
+            groups.setdefault(subject_id, []).append(class_group_id)
+    _bulk(db, models.ClassGroup, group_rows)
+
+    version_ids = list(range(1, scale.versions + 1))
+    _bulk(db, models.TimetableVersion, [
+        {"version_id": version_id, "created_by": admin_id, "creation_date": datetime(2025, 7, version_id),
+         "phase": models.TimetablePhase.proposal, "description": f"Benchmark version {version_id}"}
+        for version_id in version_ids
+    ])
+
+    # Room slots are handed out per version without repetition
+    slots = [(room["room_id"], day, hour) for room in rooms for day in DAYS for hour in range(FIRST_HOUR, LAST_HOUR)]
+    per_version = scale.classes // scale.versions
+    if per_version > len(slots):
+        raise ValueError(f"{per_version} classes per version do not fit in {len(slots)} room slots")
+    term_start = date(2025, 9, 15)
+    classes, assignments = [], []
+    for version_id in version_ids:
+        for room_id, day, hour in rng.sample(slots, per_version):
+            class_id = len(classes) + 1
+            subject_id = rng.randint(1, scale.subjects)
+            one_off = rng.random() < 0.05
+            status = rng.choices(list(models.ApprovalStatus), weights=(8, 90, 2))[0]
+            classes.append({
+                "class_id": class_id, "subject_id": subject_id, "class_type": rng.choice(list(models.ClassType)),
+                "teacher_id": rng.choice(teacher_ids), "room_id": room_id,
+                "day_of_week": None if one_off else day,
+                "date": term_start + timedelta(weeks=rng.randint(0, 14), days=day - 1) if one_off else None,
+                "start_time": time(hour), "end_time": time(hour + 1), "is_recurring": not one_off,
+                "approval_status": status, "version_id": version_id,
+            })
+            assignments.append({"class_id": class_id, "class_group_id": rng.choice(groups[subject_id])})
+    _bulk(db, models.Class, classes)
+    db.execute(insert(models.class_group_assignments), assignments)
+
+    _bulk(db, models.CalendarEvent, [
+        {"name": "Christmas break", "start_date": date(2025, 12, 22), "end_date": date(2026, 1, 2),
+         "type": models.EventType.break_},
+        {"name": "Carnival", "start_date": date(2026, 2, 17), "end_date": date(2026, 2, 17),
+         "type": models.EventType.holiday},
+    ])
+
+    # Two thirds pending, the rest already answered
+    approvals, pending = [], []
+    for approval_id in range(1, scale.approvals + 1):
+        row = {"approval_id": approval_id, "class_id": rng.randint(1, len(classes)),
+               "requested_by": rng.choice(teacher_ids), "request_date": datetime(2025, 8, 1),
+               "status": models.ApprovalStatus.pending, "approved_by": None, "response_date": None}
+        if approval_id % 3:
+            pending.append(approval_id)
+        else:
+            row.update(status=models.ApprovalStatus.approved, approved_by=admin_id,
+                       response_date=datetime(2025, 8, 2))
+        approvals.append(row)
+    _bulk(db, models.Approval, approvals)
+
+    db.commit()
+    return World(
+        admin_id=admin_id,
+        class_count=len(classes),
+        usernames=[user["username"] for user in users],
+        room_ids=[room["room_id"] for room in rooms],
+        version_ids=version_ids,
+        pending_approval_ids=pending,
+    )
@@ -0,0 +1,153 @@
+"""
+Hot-path scenarios and the loop that measures them.
+
+Requests go through the real ASGI app in-process (httpx's ASGITransport),
+so middleware, dependencies, validation and serialization are all included,
+but not the network or uvicorn. Queries per request are read from the
+Server-Timing header set by app.instrumentation.
+"""
+import asyncio
+import re
+from random import Random
+from statistics import mean, quantiles
+from time import perf_counter
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import httpx
+
+from benchmarks.data import PASSWORD, World
+
+STATEMENTS = re.compile(r'desc="(\d+) statements"')
+
+# (method, url, json body) of the i-th request
+RequestFactory = Callable[[World, Random, int], Tuple[str, str, Optional[dict]]]
+
+
+class Scenario(NamedTuple):
+    name: str
+    requests: int
+    make_request: RequestFactory
+
+
+class Result(NamedTuple):
+    name: str
+    requests: int
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    throughput_rps: float
+    queries_per_request: float
+
+    def as_dict(self) -> Dict[str, float]:
+        return {field: round(value, 3) for field, value in self._asdict().items() if field != "name"}
+
+
+def _page(world: World, rng: Random) -> int:
+    return rng.randrange(0, max(world.class_count - 100, 1), 100)
+
+
+def _read_classes(world, rng, i):
+    return "GET", f"/classes/?skip={_page(world, rng)}&limit=100", None
+
+
+def _read_classes_flat(world, rng, i):
+    return "GET", f"/classes/?skip={_page(world, rng)}&limit=100&view=flat", None
+
+
+def _login(world, rng, i):
+    return "POST", "/auth/login", {"username": rng.choice(world.usernames), "password": PASSWORD}
+
+
+def _room_classes(world, rng, i):
+    return "GET", f"/rooms/{rng.choice(world.room_ids)}/classes", None
+
+
+def _pending_approvals(world, rng, i):
+    return "GET", "/approvals/pending", None
+
+
+def _respond_approval(world, rng, i):
+    # Each request answers a different pending approval
+    if i >= len(world.pending_approval_ids):
+        raise RuntimeError("Not enough pending approvals for respond_approval; use a larger scale")
+    approval_id = world.pending_approval_ids[i]
+    return "PUT", f"/approvals/{approval_id}/respond", {"approved_by": world.admin_id, "status": "approved"}
+
+
+# Login is bounded by bcrypt (BCRYPT_ROUNDS), hence fewer requests
+SCENARIOS: List[Scenario] = [
+    Scenario("read_classes", 200, _read_classes),
+    Scenario("read_classes_flat", 200, _read_classes_flat),
+    Scenario("get_room_classes", 200, _room_classes),
+    Scenario("login", 20, _login),
+    Scenario("pending_approvals", 50, _pending_approvals),
+    Scenario("respond_approval", 100, _respond_approval),
+]
+
+
+def _percentile(sorted_ms: List[float], q: int) -> float:
+    if len(sorted_ms) == 1:
+        return sorted_ms[0]
+    return quantiles(sorted_ms, n=100, method="inclusive")[q - 1]
+
+
+async def run_scenario(
+    client: httpx.AsyncClient, scenario: Scenario, world: World, requests: int, concurrency: int, warmup: int, seed: int
+) -> Result:
+    rng = Random(seed)
+    # Warm-up requests use their own indexes, so writes never repeat
+    planned = [scenario.make_request(world, rng, i) for i in range(warmup + requests)]
+    latencies: List[float] = []
+    statements: List[int] = []
+    position = 0
+
+    async def send(method: str, url: str, body: Optional[dict], record: bool):
+        start = perf_counter()
+        response = await client.request(method, url, json=body)
+        elapsed = perf_counter() - start
+        if response.status_code != 200:
+            raise RuntimeError(f"{scenario.name}: {method} {url} returned {response.status_code}: {response.text[:200]}")
+        if record:
+            latencies.append(elapsed * 1000)
+            match = STATEMENTS.search(response.headers.get("server-timing", ""))
+            statements.append(int(match.group(1)) if match else 0)
+
+    for method, url, body in planned[:warmup]:
+        await send(method, url, body, False)
+
+    async def worker():
+        nonlocal position
+        while position < len(planned):
+            method, url, body = planned[position]
+            position += 1
+            await send(method, url, body, True)
+
+    position = warmup
+    start = perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = perf_counter() - start
+
+    latencies.sort()
+    return Result(
+        name=scenario.name,
+        requests=len(latencies),
+        p50_ms=_percentile(latencies, 50),
+        p95_ms=_percentile(latencies, 95),
+        p99_ms=_percentile(latencies, 99),
+        throughput_rps=len(latencies) / elapsed,
+        queries_per_request=mean(statements),
+    )
+
+
+async def run_all(
+    app, world: World, names: Optional[List[str]], factor: float, concurrency: int, warmup: int, seed: int
+) -> List[Result]:
+    transport = httpx.ASGITransport(app=app)
+    results = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        for scenario in SCENARIOS:
+            if names and scenario.name not in names:
+                continue
+            requests = max(1, int(scenario.requests * factor))
+            results.append(await run_scenario(client, scenario, world, requests, concurrency, warmup, seed))
+    return results
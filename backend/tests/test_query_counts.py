@@ -0,0 +1,93 @@
+"""
+Statements per request for the list and approval endpoints.
+
+Each endpoint must run a fixed number of statements however many rows it
+returns, so the bounds below catch a relationship falling back to lazy
+loading (an N+1) as soon as it happens. The database is a temporary SQLite
+file filled with the benchmark data generator.
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+import pytest
+
+# Read by app.database at import time
+os.environ["DATABASE_URL"] = f"sqlite:///{Path(tempfile.mkdtemp(prefix='horarios-test-')) / 'test.db'}"
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+from app.database import SessionLocal, async_engine, engine, init_db  # noqa: E402
+from app.main import app  # noqa: E402
+from benchmarks.data import Scale, populate  # noqa: E402
+
+SCALE = Scale(locations=2, schools=2, courses=4, rooms=8, subjects=20, teachers=10, classes=200, versions=2,
+              approvals=40)
+
+
+@pytest.fixture(scope="module")
+def world():
+    init_db()
+    with SessionLocal() as db:
+        return populate(db, SCALE)
+
+
+@pytest.fixture(scope="module")
+def client(world):
+    return TestClient(app)
+
+
+@contextmanager
+def count_statements():
+    """Collect the SQL run on the sync and async engines"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engines = (engine, async_engine.sync_engine)
+    for target in engines:
+        event.listen(target, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        for target in engines:
+            event.remove(target, "before_cursor_execute", before_cursor_execute)
+
+
+def assert_statements(client, method, url, limit, json=None):
+    with count_statements() as statements:
+        response = client.request(method, url, json=json)
+    assert response.status_code == 200, response.text
+    assert len(statements) <= limit, "\n".join(statements)
+    return response
+
+
+@pytest.mark.parametrize("limit", [5, 100])
+def test_list_classes(client, limit):
+    response = assert_statements(client, "GET", f"/classes/?limit={limit}", 3)
+    assert len(response.json()) == limit
+
+
+def test_room_classes(client, world):
+    response = assert_statements(client, "GET", f"/rooms/{world.room_ids[0]}/classes", 3)
+    assert response.json()
+
+
+@pytest.mark.parametrize("limit", [5, 100])
+def test_list_approvals(client, limit):
+    response = assert_statements(client, "GET", f"/approvals/?limit={limit}", 3)
+    assert len(response.json()) == min(limit, SCALE.approvals)
+
+
+def test_respond_approval(client, world):
+    approval_id = world.pending_approval_ids[0]
+    body = {"approved_by": world.admin_id, "status": "approved"}
+    response = assert_statements(client, "PUT", f"/approvals/{approval_id}/respond", 5, body)
+    approval = response.json()
+    assert approval["status"] == "approved"
+    assert approval["approver"]["user_id"] == world.admin_id
+    assert approval["class_"]["class_id"] == approval["class_id"]